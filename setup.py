@@ -4,8 +4,8 @@ from setuptools import setup
 import os
 import sys
 
-if sys.version_info < (3, 2, 0):
-    raise Exception("Only python 3.2+ is supported.")
+if sys.version_info < (3, 5, 0):
+    raise Exception("Only python 3.5+ is supported.")
 
 
 def read(fname):
@@ -36,9 +36,7 @@ setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.2",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4"
+        "Programming Language :: Python :: 3.5"
     ],
     install_requires=[
         "requests == 2.7.0",
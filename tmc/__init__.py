@@ -1,23 +1,33 @@
 import sys
-import os
-
-# begin by checking for curses
-try:
-    import curses
-except ImportError:
-    if os.name == "nt":
-        print("You seem to be running Windows. Please install curses",
-              "from http://www.lfd.uci.edu/~gohlke/pythonlibs/#curses")
-    else:
-        print("You don't have curses installed, please install it with",
-              "your package manager.")
-    exit(-1)
 
 from tmc.config import Config
 conf = Config()
 
 from tmc.unicode_characters import UnicodePrint
-sys.stdout = UnicodePrint(conf.use_unicode_characters)
+sys.stdout = UnicodePrint(conf=conf)
 
-from tmc.api import API
-api = API()
+
+class LazyAPI(object):
+    """
+    Stands in for the API and creates it the first time it's used. The API
+    brings in the database, the store and the caches, which commands like
+    `tmc version` don't need.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_api", None)
+
+    def _get(self):
+        if self._api is None:
+            from tmc.api import API
+            object.__setattr__(self, "_api", API())
+        return self._api
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+
+
+api = LazyAPI()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import atexit
 import os
 import sys
 
@@ -9,7 +10,6 @@ from functools import wraps
 from getpass import getpass
 from subprocess import Popen
 
-import peewee
 import argh
 from argh.decorators import aliases, arg
 
@@ -17,11 +17,7 @@ from tmc import conf
 from tmc import api
 from tmc.errors import (APIError, NoCourseSelected, NoExerciseSelected,
                         TMCError, TMCExit)
-from tmc.exercise_tests.basetest import run_test
-from tmc.files import download_exercise, submit_exercise
-from tmc.models import Config, Course, Exercise, reset_db
-from tmc.coloring import infomsg
-from tmc.ui.menu import Menu
+from tmc.coloring import infomsg, warningmsg
 from tmc.ui.prompt import custom_prompt, yn_prompt
 from tmc.ui.spinner import Spinner
 from tmc.version import __version__
@@ -41,6 +37,8 @@ def selected_course(func):
     """
     @wraps(func)
     def inner(*args, **kwargs):
+        from tmc.models import Course
+
         course = Course.get_selected()
         return func(course, *args, **kwargs)
     return inner
@@ -52,6 +50,8 @@ def selected_exercise(func):
     """
     @wraps(func)
     def inner(*args, **kwargs):
+        from tmc.models import Exercise
+
         exercise = Exercise.get_selected()
         return func(exercise, *args, **kwargs)
     return inner
@@ -74,12 +74,17 @@ def false_exit(func):
 
 
 def check_for_updates():
-    from xmlrpc.client import ServerProxy
-    from distutils.version import StrictVersion
-    pypi = ServerProxy("https://pypi.python.org/pypi")
-    version = StrictVersion(__version__)
-    pypiversion = StrictVersion(pypi.package_releases("tmc")[0])
-    if pypiversion > version:
+    """
+    Checks PyPI for a newer version of tmc.py.
+    """
+    from tmc import updates
+
+    try:
+        pypiversion = updates.fetch_latest_version()
+    except (OSError, ValueError, KeyError) as e:
+        raise TMCError("Couldn't check PyPI for updates: {0}".format(e))
+    version = updates.parse_version(__version__)
+    if updates.parse_version(pypiversion) > version:
         infomsg("There is a new version available. ({})".format(pypiversion))
         print("You can upgrade tmc.py with either of these ways, depending",
               "on the way you installed tmc.py in the first place.",
@@ -87,7 +92,7 @@ def check_for_updates():
               "\n    sudo pip install --upgrade tmc",
               "\nIf you installed it with the installation script:",
               "\n    Run the script again and select upgrade.")
-    elif pypiversion < version:
+    elif updates.parse_version(pypiversion) < version:
         print("You are running a newer version than available.")
     else:
         print("You are running the most current version.")
@@ -105,6 +110,8 @@ def configure(server=None, username=None, password=None, tid=None, auto=False):
     """
     Configure tmc.py to use your account.
     """
+    from tmc.models import Config, reset_db
+
     if not server and not username and not password and not tid:
         if Config.has():
             if not yn_prompt("Override old configuration", False):
@@ -179,30 +186,35 @@ def current(exercise):
      help="Should the Java target be upgraded from 1.6 to 1.7")
 @arg("-u", "--update", default=False, action="store_true",
      help="Update the tests of the exercise.")
+@arg("--jobs", type=int, default=4,
+     help="How many exercises to download at once.")
 @selected_course
 def download(course, tid=None, dl_all=False, force=False, upgradejava=False,
-             update=False):
+             update=False, jobs=4):
     """
     Download the exercises from the server.
     """
+    from tmc.files import download_exercise, download_exercises
+    from tmc.models import Exercise
 
-    def dl(id):
-        download_exercise(Exercise.get(Exercise.tid == id),
+    if tid is not None:
+        download_exercise(Exercise.get(Exercise.tid == int(tid)),
                           force=force,
                           update_java=upgradejava,
                           update=update)
+        return
 
-    if dl_all:
-        for exercise in list(course.exercises):
-            dl(exercise.tid)
-    elif tid is not None:
-        dl(int(tid))
-    else:
-        for exercise in list(course.exercises):
-            if not exercise.is_completed:
-                dl(exercise.tid)
-            else:
-                exercise.update_downloaded()
+    exercises = []
+    for exercise in list(course.exercises):
+        if dl_all or not exercise.is_completed:
+            exercises.append(exercise)
+        else:
+            exercise.update_downloaded()
+
+    failed = download_exercises(exercises, jobs=jobs, force=force,
+                                update_java=upgradejava, update=update)
+    if failed:
+        warningmsg("{0} exercise(s) failed to download.".format(failed))
 
 
 @aliases("next")
@@ -212,10 +224,13 @@ def skip(course, num=1):
     """
     Go to the next exercise.
     """
+    from peewee import DoesNotExist
+    from tmc.models import Exercise
+
     sel = None
     try:
         sel = Exercise.get_selected()
-        if sel.course.tid != course.tid:
+        if sel.get_course().tid != course.tid:
             sel = None
     except NoExerciseSelected:
         pass
@@ -224,8 +239,8 @@ def skip(course, num=1):
         sel = course.exercises.first()
     else:
         try:
-            sel = Exercise.get(Exercise.id == sel.id + num)
-        except peewee.DoesNotExist:
+            sel = Exercise.cached(sel.id + num)
+        except DoesNotExist:
             print("There are no more exercises in this course.")
             return False
 
@@ -246,6 +261,8 @@ def reset():
     print("This won't remove any of your files,",
           "but instead the local database that tracks your progress.")
     if yn_prompt("Reset database", False):
+        from tmc.models import reset_db
+
         reset_db()
         print("Database resetted. You will need to tmc configure again.")
 
@@ -263,12 +280,16 @@ def run(exercise, command):
 @arg("-c", "--course", action="store_true", help="Select a course instead.")
 @arg("-i", "--id", dest="tid",
      help="Select this ID without invoking the curses UI.")
-def select(course=False, tid=None, auto=False):
+@arg("--no-cache", default=False, action="store_true",
+     help="Don't use cached course data.")
+def select(course=False, tid=None, auto=False, no_cache=False):
     """
     Select a course or an exercise.
     """
+    from tmc.models import Course, Exercise
+
     if course:
-        update(course=True)
+        update(course=True, no_cache=no_cache)
         course = None
         try:
             course = Course.get_selected()
@@ -277,6 +298,7 @@ def select(course=False, tid=None, auto=False):
 
         ret = {}
         if not tid:
+            from tmc.ui.menu import Menu
             ret = Menu.launch("Select a course",
                               Course.select().execute(),
                               course)
@@ -284,7 +306,7 @@ def select(course=False, tid=None, auto=False):
             ret["item"] = Course.get(Course.tid == tid)
         if "item" in ret:
             ret["item"].set_select()
-            update()
+            update(no_cache=no_cache)
             if ret["item"].path == "":
                 select_a_path(auto=auto)
             # Selects the first exercise in this course
@@ -302,9 +324,12 @@ def select(course=False, tid=None, auto=False):
 
         ret = {}
         if not tid:
+            from tmc.ui.menu import Menu
             ret = Menu.launch("Select an exercise",
-                              Course.get_selected().exercises,
+                              Exercise.rows(Course.get_selected()),
                               selected)
+            if "item" in ret:
+                ret["item"] = Exercise.byid(ret["item"].tid)
         else:
             ret["item"] = Exercise.byid(tid)
         if "item" in ret:
@@ -313,26 +338,57 @@ def select(course=False, tid=None, auto=False):
 
 
 @aliases("su")
-@arg("-i", "--id", dest="tid", help="Submit this ID.")
+@arg("-i", "--id", dest="tid", nargs="+", help="Submit these IDs.")
+@arg("-a", "--all-changed", default=False, action="store_true",
+     help="Submit every exercise that has changed since it was downloaded.")
+@arg("--jobs", type=int, default=4,
+     help="How many exercises to send at once.")
 @arg("-p", "--pastebin", default=False, action="store_true",
      help="Should the submission be sent to TMC pastebin.")
 @arg("-r", "--review", default=False, action="store_true",
      help="Request a review for this submission.")
+@arg("-t", "--timeout", type=int, default=300,
+     help="How many seconds to wait for the results.")
 @selected_course
 @false_exit
-def submit(course, tid=None, pastebin=False, review=False):
+def submit(course, tid=None, pastebin=False, review=False, timeout=300,
+           all_changed=False, jobs=4):
     """
     Submit the selected exercise to the server.
     """
+    from tmc.files import has_changed, submit_exercise, submit_exercises
+    from tmc.models import Exercise
+
+    exercises = None
+    if all_changed:
+        changes = [(ex, has_changed(ex)) for ex in course.exercises]
+        unknown = [ex for ex, changed in changes
+                   if changed is None and not ex.is_completed]
+        if unknown:
+            ids = " ".join(str(ex.tid) for ex in unknown)
+            warningmsg("Can't tell whether these exercises have changed, "
+                       "submit them with --id if they have: {0}".format(ids))
+        exercises = [ex for ex, changed in changes if changed]
+        if not exercises:
+            print("No exercises have changed.")
+            return
+    elif tid is not None and len(tid) > 1:
+        exercises = [Exercise.byid(i) for i in tid]
+    if exercises is not None:
+        return submit_exercises(exercises, jobs=jobs, pastebin=pastebin,
+                                request_review=review, timeout=timeout)
+
     if tid is not None:
-        return submit_exercise(Exercise.byid(tid),
+        return submit_exercise(Exercise.byid(tid[0]),
                                pastebin=pastebin,
-                               request_review=review)
+                               request_review=review,
+                               timeout=timeout)
     else:
         sel = Exercise.get_selected()
         if not sel:
             raise NoExerciseSelected()
-        return submit_exercise(sel, pastebin=pastebin, request_review=review)
+        return submit_exercise(sel, pastebin=pastebin, request_review=review,
+                               timeout=timeout)
 
 
 @aliases("pa")
@@ -343,7 +399,8 @@ def paste(tid=None, review=False):
     """
     Sends the selected exercise to the TMC pastebin.
     """
-    submit(pastebin=True, tid=tid, review=False)
+    submit(pastebin=True, tid=[tid] if tid is not None else None,
+           review=False)
 
 
 @aliases("te")
@@ -356,6 +413,9 @@ def test(course, tid=None, time=None):
     """
     Run tests on the selected exercise.
     """
+    from tmc.exercise_tests.basetest import run_test
+    from tmc.models import Exercise
+
     if time is not None:
         conf.tests_show_time = time
     if tid is not None:
@@ -373,6 +433,7 @@ def list_all(course, single=None):
     """
     Lists all of the exercises in the current course.
     """
+    from tmc.models import Exercise
 
     def bs(val):
         return "●" if val else " "
@@ -387,76 +448,44 @@ def list_all(course, single=None):
                                                     bc(exercise.is_completed),
                                                     exercise.menuname())
 
+    rows = Exercise.rows(course)
     print("ID{0}│ S │ D │ C │ Name".format(
-        (len(str(course.exercises[0].tid)) - 1) * " "
+        (len(str(rows[0].tid)) - 1) * " "
     ))
     if single:
         print(format_line(single))
         return
-    for exercise in course.exercises:
+    for exercise in rows:
         # ToDo: use a pager
         print(format_line(exercise))
 
 
 @aliases("up")
 @arg("-c", "--course", action="store_true", help="Update courses instead.")
-def update(course=False):
+@arg("--no-cache", default=False, action="store_true",
+     help="Don't use cached course data.")
+def update(course=False, no_cache=False):
     """
     Update the data of courses and or exercises from server.
     """
+    from tmc.files import download_exercises
+    from tmc.models import Course, Exercise
+
+    if no_cache:
+        api.use_cache = False
     if course:
         with Spinner.context(msg="Updated course metadata.",
                              waitmsg="Updating course metadata."):
-            for course in api.get_courses():
-                old = None
-                try:
-                    old = Course.get(Course.tid == course["id"])
-                except peewee.DoesNotExist:
-                    old = None
-                if old:
-                    old.details_url = course["details_url"]
-                    old.save()
-                    continue
-                Course.create(tid=course["id"], name=course["name"],
-                              details_url=course["details_url"])
+            Course.sync(api.get_courses())
     else:
         selected = Course.get_selected()
 
         # with Spinner.context(msg="Updated exercise metadata.",
         #                     waitmsg="Updating exercise metadata."):
         print("Updating exercise data.")
-        for exercise in api.get_exercises(selected):
-            old = None
-            try:
-                old = Exercise.byid(exercise["id"])
-            except peewee.DoesNotExist:
-                old = None
-            if old is not None:
-                old.name = exercise["name"]
-                old.course = selected.id
-                old.is_attempted = exercise["attempted"]
-                old.is_completed = exercise["completed"]
-                old.deadline = exercise.get("deadline")
-                old.is_downloaded = os.path.isdir(old.path())
-                old.return_url = exercise["return_url"]
-                old.zip_url = exercise["zip_url"]
-                old.submissions_url = exercise["exercise_submissions_url"]
-                old.save()
-                download_exercise(old, update=True)
-            else:
-                ex = Exercise.create(tid=exercise["id"],
-                                     name=exercise["name"],
-                                     course=selected.id,
-                                     is_attempted=exercise["attempted"],
-                                     is_completed=exercise["completed"],
-                                     deadline=exercise.get("deadline"),
-                                     return_url=exercise["return_url"],
-                                     zip_url=exercise["zip_url"],
-                                     submissions_url=exercise[("exercise_"
-                                                               "submissions_"
-                                                               "url")])
-                ex.is_downloaded = os.path.isdir(ex.path())
-                ex.save()
+        outdated = Exercise.sync(selected, api.get_exercises(selected))
+        if outdated:
+            download_exercises(outdated, update=True)
 
 
 @selected_course
@@ -475,8 +504,7 @@ def select_a_path(course, auto=False):
     if not path.startswith("/"):
         path = os.path.join(os.getcwd(), path)
     print("Using path: '{}'".format(path))
-    course.path = path
-    course.save()
+    course.set_path(path)
     if auto:
         return
     ret = custom_prompt("Download exercises R: Remaining A: All N: None",
@@ -498,62 +526,50 @@ def version():
     print("Copyright 2014 tmc.py contributors")
 
 
-def should_update():
-    from xmlrpc.client import ServerProxy
-    from distutils.version import StrictVersion
-    from datetime import datetime
-    import calendar
-
-    current_version = StrictVersion(__version__)
-    last_value = (Config.has_name("needs_update")
-                  and Config.get_value("needs_update") == "1")
-    last_version = (0, 0, 0)
-    if Config.has_name("last_version"):
-        last_version = StrictVersion(Config.get_value("last_version"))
-
-    # Return false if an upgrade has happened
-    if last_value and (last_version < current_version):
-        return False
-
-    Config.set("last_version", __version__)
-
-    # Next lets check the time
-    last_time = None
-    if Config.has_name("last_update_check"):
-        last_time = datetime.utcfromtimestamp(int(
-            Config.get_value("last_update_check")))
-    else:
-        last_time = datetime.now()
-
-    if (last_time - datetime.now()).days < 7:
-        return False
-
-    Config.set("last_update_check",
-               calendar.timegm(datetime.now().timetuple()))
+commands = [select, update, download, test, submit, skip, current, previous,
+            reset, configure, version, list_all, run, check_for_updates,
+            paste]
 
-    # Lastly lets check pypi for versions
-    pypi = ServerProxy("http://pypi.python.org/pypi")
-    pypiversion = StrictVersion(pypi.package_releases("tmc")[0])
 
-    if pypiversion > current_version:
-        return True
-    return False
+def trace_http():
+    """
+    Enables tracing of HTTP requests if either --trace-http was given or
+    TMC_TRACE_HTTP names a file to trace into.
+    """
+    filename = os.environ.get("TMC_TRACE_HTTP")
+    if "--trace-http" in sys.argv:
+        from tmc.models import target_file
 
+        sys.argv.remove("--trace-http")
+        # Not into the current directory, which may be the src directory
+        # of an exercise.
+        filename = filename or os.path.join(os.path.dirname(target_file),
+                                            "tmc-http-trace.jsonl")
+    if not filename:
+        return
+    from tmc.tracing import HTTPTracer
 
-commands = [select, update, download, test, submit, skip, current, previous,
-            reset, configure, version, list_all, run, check_for_updates,
-            paste]
+    api.tracer = HTTPTracer(filename)
+    atexit.register(api.tracer.print_summary)
 
 
 def main():
     parser = argh.ArghParser()
     parser.add_commands(commands)
 
-    needs_update = should_update()
-    Config.set("needs_update", "1" if needs_update else "0")
-    if needs_update:
-        infomsg("Update available to tmc.py. See tmc check-for-updates",
-                "for more info.")
+    trace_http()
+
+    # Printing the version or help doesn't need the database, so don't open
+    # it just for the update check. The check itself runs in the background
+    # and its result is reported by the next command.
+    quiet_commands = ("version", "help", "-h", "--help")
+    if len(sys.argv) > 1 and sys.argv[1] not in quiet_commands:
+        from tmc import updates
+
+        if updates.newer_version():
+            infomsg("Update available to tmc.py. See tmc check-for-updates",
+                    "for more info.")
+        updates.check_in_background()
 
     # By default Argh only shows shortened help when no command is given.
     # This makes it print out the full help instead.
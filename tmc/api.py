@@ -1,10 +1,15 @@
+import heapq
+import os
+import threading
+import time
 from functools import partial
 
-from requests import request
-from requests.exceptions import RequestException
-
+from tmc.backoff import (Backoff, CircuitBreaker, RetryPolicy,
+                         parse_retry_after)
+from tmc.cache import PartialDownload, ResponseCache
 from tmc.errors import APIError
-from tmc.models import Config
+from tmc.models import Config, target_file
+from tmc.store import ExerciseStore, default_directory
 
 
 # from tmc.version import __version__
@@ -14,7 +19,7 @@ class API:
 
     """Handles communication with TMC server."""
 
-    def __init__(self):
+    def __init__(self, pool_size=10):
         self.server_url = ""
         self.auth_header = ""
         self.configured = False
@@ -35,6 +40,36 @@ class API:
         self.get = partial(self._do_request, "GET")
         self.post = partial(self._do_request, "POST")
 
+        # Transient failures of GETs are retried, and once the server looks
+        # to be down requests fail fast instead of timing out one by one.
+        self.retry_policy = RetryPolicy()
+        self.breaker = CircuitBreaker()
+
+        # An HTTPTracer, when requests should be traced.
+        self.tracer = None
+
+        # Every thread gets its own keep-alive session so that worker
+        # threads can share the API object without sharing a Session.
+        self.pool_size = pool_size
+        self._local = threading.local()
+
+        # Course listings and details are cached next to the database and
+        # revalidated with conditional requests.
+        self.use_cache = True
+        self.cache = ResponseCache(os.path.join(os.path.dirname(target_file),
+                                                "tmc-cache"))
+
+        # Unfinished exercise downloads are kept here so they can be resumed.
+        self.download_dir = os.path.join(os.path.dirname(target_file),
+                                         "tmc-downloads")
+        # Connect and read timeouts for zip downloads. The read timeout also
+        # applies between blocks of the body, so a stalled connection fails
+        # and gets resumed instead of hanging forever.
+        self.zip_timeout = (10, 30)
+
+        # Finished downloads go to a store shared by every course path.
+        self.store = ExerciseStore(default_directory())
+
     def configure(self, url=None, token=None, test=False):
         """
         Configure the api to use given url and token or to get them from the
@@ -59,26 +94,122 @@ class API:
     def test_connection(self):
         self.make_request("courses.json")
 
-    def make_request(self, slug, timeout=10):
-        resp = self.get(slug, timeout=timeout)
-        return self._to_json(resp)
+    def make_request(self, slug, timeout=10, cache=False):
+        if not cache or not self.use_cache:
+            resp = self.get(slug, timeout=timeout)
+            return self._to_json(resp)
+        return self._make_cached_request(slug, timeout)
+
+    def _make_cached_request(self, slug, timeout):
+        """
+        Does a conditional GET using the validators of a previously cached
+        response. If the server answers 304 the cached JSON is reused.
+        """
+        if not self.configured:
+            self.configure()
+        url = self._make_url(slug)
+        identity = self.auth_header["Authorization"]
+        cached = self.cache.get(url, identity)
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        resp = self.get(slug, timeout=timeout, headers=headers)
+        if resp.status_code == 304 and cached is not None:
+            self.cache.touch(url, identity)
+            return cached["body"]
+        json = self._to_json(resp)
+        self.cache.put(url, identity, resp.headers, json)
+        return json
 
     def get_courses(self):
-        return self.make_request("courses.json")["courses"]
+        return self.make_request("courses.json", cache=True)["courses"]
 
     def get_exercises(self, course):
-        resp = self.make_request(course.details_url)
+        resp = self.make_request(course.details_url, cache=True)
         return resp["course"]["exercises"]
 
-    def get_zip_stream(self, exercise, tmpfile_handle):
-        resp = self.get(exercise.zip_url, stream=True)
+    def get_zip_stream(self, exercise, attempts=3):
+        """
+        Downloads the zip of exercise into a PartialDownload and returns it
+        once complete. A transfer that breaks off or stalls is resumed with a
+        Range request if the server supports it and restarted from the
+        beginning otherwise. If every attempt fails the partial file is left
+        on disk so that the next run can continue from it.
+        """
+        partial = PartialDownload(self.download_dir, exercise.zip_url)
+        for attempt in range(attempts):
+            offset, validator = partial.resume_point()
+            headers = {}
+            if offset:
+                headers["Range"] = "bytes={0}-".format(offset)
+                headers["If-Range"] = validator
+            # Failed requests have already been retried by _do_request, only
+            # transfers that break off midway are tried again here.
+            resp = self.get(exercise.zip_url, stream=True, headers=headers,
+                            timeout=self.zip_timeout)
+            try:
+                self._write_zip_stream(resp, partial, offset)
+            except APIError:
+                if attempt == attempts - 1:
+                    raise
+                continue
+            if partial.is_complete():
+                return partial
+        raise APIError("Download of {0} did not complete".format(
+            exercise.zip_url))
+
+    def _write_zip_stream(self, resp, partial, offset):
+        from requests.exceptions import RequestException
 
-        for block in resp.iter_content(1024):
-            if not block:
-                break
-            tmpfile_handle.write(block)
+        if resp.status_code == 206:
+            # Content-Range: bytes <start>-<end>/<length>
+            length = resp.headers.get("Content-Range", "").split("/")[-1]
+        else:
+            offset = 0
+            length = resp.headers.get("Content-Length")
+        length = int(length) if length and length.isdigit() else None
+        validator = (resp.headers.get("ETag")
+                     or resp.headers.get("Last-Modified"))
+
+        chunk_size = self._chunk_size(length)
+        received = 0
+        try:
+            with partial.open(offset, length, validator) as fp:
+                for block in resp.iter_content(chunk_size):
+                    if not block:
+                        break
+                    fp.write(block)
+                    received += len(block)
+        except RequestException as e:
+            self._trace_stream(resp, received, e)
+            reason = "Download of {0} was interrupted: {1}"
+            raise APIError(reason.format(resp.url, repr(e)))
+        self._trace_stream(resp, received)
+
+    def _trace_stream(self, resp, received, error=None):
+        """
+        Records a streamed request once its body has been read, so that the
+        trace covers the whole transfer.
+        """
+        if self.tracer and hasattr(resp, "trace"):
+            method, url, started, attempt = resp.trace
+            self.tracer.record(method, url, started, resp, attempt,
+                               error=error, received=received)
 
-        return resp
+    @staticmethod
+    def _chunk_size(content_length, minimum=64 * 1024, maximum=1024 * 1024):
+        """
+        Picks a read size for a streamed download so that large archives are
+        read in large blocks and small ones don't overallocate.
+        """
+        try:
+            size = int(content_length) // 64
+        except (TypeError, ValueError):
+            return minimum
+        return max(minimum, min(maximum, size))
 
     def send_zip(self, exercise, file, params):
         """
@@ -98,10 +229,66 @@ class API:
         return self._to_json(resp)
 
     def get_submission(self, url):
-        resp = self.make_request(url)
-        if resp["status"] == "processing":
-            return None
-        return resp
+        data, _ = self.poll_submission(url)
+        return data
+
+    def poll_submission(self, url):
+        """
+        Fetches a submission once. Returns the submission data, or None while
+        it's still processing, and the least amount of seconds to wait before
+        polling again as hinted by the server.
+        """
+        resp = self.get(url, timeout=10)
+        data = self._to_json(resp)
+        if data["status"] != "processing":
+            return data, 0
+        wait = parse_retry_after(resp.headers.get("Retry-After")) or 0
+        # Each submission ahead of ours in the queue takes a while to run.
+        queued = data.get("submissions_before_this") or 0
+        return None, max(wait, min(queued * 0.5, 10))
+
+    def wait_for_submission(self, url, timeout=300):
+        """
+        Polls a submission until it has been processed. Polls quickly at
+        first and backs off the longer the results take.
+        """
+        data = self.wait_for_submissions([url], timeout=timeout)[url]
+        if data is None:
+            reason = "No results for {0} after {1} seconds"
+            raise APIError(reason.format(url, timeout))
+        return data
+
+    def wait_for_submissions(self, urls, timeout=300):
+        """
+        Polls many submissions on this thread until they have been processed.
+        Every submission backs off on its own and the one that is due first
+        is polled next.
+
+        Returns a dict from url to the submission data, or to None if there
+        were no results before the timeout. A submission that can't be polled
+        gets an "error" status like the ones the server sends.
+        """
+        deadline = time.time() + timeout
+        results = dict.fromkeys(urls)
+        queue = [(time.time(), index, url, Backoff(initial=0.5, maximum=10))
+                 for index, url in enumerate(urls)]
+        while queue:
+            due, index, url, backoff = heapq.heappop(queue)
+            if due > deadline:
+                continue
+            if due > time.time():
+                time.sleep(due - time.time())
+            try:
+                data, wait = self.poll_submission(url)
+            except APIError as e:
+                results[url] = {"status": "error", "error": e.value}
+                continue
+            if data:
+                results[url] = data
+                continue
+            due = time.time() + backoff.next(minimum=wait)
+            heapq.heappush(queue, (due, index, url, backoff))
+        return results
 
     def _make_url(self, slug):
         """
@@ -113,11 +300,35 @@ class API:
             return slug
         return "{0}{1}".format(self.server_url, slug)
 
+    @property
+    def session(self):
+        """
+        The keep-alive session of the calling thread. Connections to the
+        server are pooled and reused between requests.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            # requests takes a while to import, so only do it when a command
+            # actually talks to the server.
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+
+            session = Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                  pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+        return session
+
     def _do_request(self, method, slug, **kwargs):
         """
         Does HTTP request sending / response validation.
         Prevents RequestExceptions from propagating
         """
+        from requests import exceptions
+        from requests.exceptions import RequestException
+
         # ensure we are configured
         if not self.configured:
             self.configure()
@@ -131,19 +342,71 @@ class API:
             # override default's value with kwargs's one if existing.
             kwargs[item] = dict(defaults[item], **(kwargs.get(item, {})))
 
-        # request() can raise connectivity related exceptions.
-        # raise_for_status raises an exception ONLY if the response
-        # status_code is "not-OK" i.e 4XX, 5XX..
-        #
-        # All of these inherit from RequestException
-        # which is "translated" into an APIError.
-        try:
-            resp = request(method, url, **kwargs)
-            resp.raise_for_status()
-        except RequestException as e:
-            reason = "HTTP {0} request to {1} failed: {2}"
-            raise APIError(reason.format(method, url, repr(e)))
-        return resp
+        # Idempotent requests get a few more tries when the failure looks
+        # transient, everything else gets exactly one.
+        attempts = 1
+        if self.retry_policy.applies_to(method):
+            attempts = self.retry_policy.attempts
+        backoff = self.retry_policy.backoff()
+
+        # The breaker counts failed requests, not failed attempts, so it's
+        # only asked once and told the outcome after the retries.
+        if not self.breaker.allow():
+            reason = ("HTTP {0} request to {1} not sent: the TMC server "
+                      "seems to be down, try again later")
+            raise APIError(reason.format(method, url))
+
+        for attempt in range(1, attempts + 1):
+            # request() can raise connectivity related exceptions.
+            # raise_for_status raises an exception ONLY if the response
+            # status_code is "not-OK" i.e 4XX, 5XX..
+            #
+            # All of these inherit from RequestException
+            # which is "translated" into an APIError.
+            started = time.time()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (exceptions.ConnectionError, exceptions.Timeout) as e:
+                if self.tracer:
+                    self.tracer.record(method, url, started, attempt=attempt,
+                                       error=e)
+                if attempt < attempts:
+                    time.sleep(self.retry_policy.delay(backoff))
+                    continue
+                self.breaker.record_failure()
+                reason = "HTTP {0} request to {1} failed: {2}"
+                raise APIError(reason.format(method, url, repr(e)))
+            except RequestException as e:
+                if self.tracer:
+                    self.tracer.record(method, url, started, attempt=attempt,
+                                       error=e)
+                reason = "HTTP {0} request to {1} failed: {2}"
+                raise APIError(reason.format(method, url, repr(e)))
+            if self.tracer:
+                if kwargs.get("stream") and resp.ok:
+                    # Only the headers have arrived, the request is recorded
+                    # by _trace_stream once the body has been read.
+                    resp.trace = (method, url, started, attempt)
+                else:
+                    self.tracer.record(method, url, started, resp, attempt)
+
+            if (resp.status_code in self.retry_policy.statuses
+                    and attempt < attempts):
+                resp.close()
+                time.sleep(self.retry_policy.delay(
+                    backoff, resp.headers.get("Retry-After")))
+                continue
+            if resp.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+            try:
+                resp.raise_for_status()
+            except RequestException as e:
+                reason = "HTTP {0} request to {1} failed: {2}"
+                raise APIError(reason.format(method, url, repr(e)))
+            return resp
 
     def _to_json(self, resp):
         """
@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Files are written through temporary files, which are created private, so
+# the umask is needed to give them the permissions a normal file would get.
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def member_path(outpath, filename):
+    """
+    Where a zip member called filename goes inside outpath. Like zipfile,
+    drops absolute prefixes and ".." components so nothing ends up outside
+    of outpath.
+    """
+    filename = filename.replace("/", os.path.sep)
+    filename = os.path.splitdrive(filename)[1]
+    parts = [part for part in filename.split(os.path.sep)
+             if part not in ("", os.path.curdir, os.path.pardir)]
+    return os.path.join(outpath, *parts)
+
+
+def is_unchanged(info, target):
+    """
+    Does target already have the contents of the zip member info. Compares
+    the size first and the CRC-32 only if the sizes match.
+    """
+    try:
+        if os.path.getsize(target) != info.file_size:
+            return False
+        crc = 0
+        with open(target, "rb") as fp:
+            for block in iter(lambda: fp.read(64 * 1024), b""):
+                crc = zlib.crc32(block, crc)
+    except OSError:
+        return False
+    return crc & 0xffffffff == info.CRC
+
+
+def member_mtime(info):
+    """
+    The modification time stored in the archive for a member, which is in
+    local time.
+    """
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def write_member(zipfp, info, target, preserve_time=False):
+    """
+    Writes the zip member info to target atomically: the contents go to a
+    temporary file next to target, which then replaces it. With
+    preserve_time the file gets the modification time from the archive.
+    """
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=directory, prefix=".tmc-")
+    try:
+        with os.fdopen(fd, "wb") as dst, zipfp.open(info) as src:
+            shutil.copyfileobj(src, dst, 64 * 1024)
+        if os.path.isfile(target):
+            shutil.copymode(target, tmppath)
+        else:
+            os.chmod(tmppath, 0o666 & ~_umask)
+        if preserve_time:
+            mtime = member_mtime(info)
+            os.utime(tmppath, (mtime, mtime))
+        os.replace(tmppath, target)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+def extract_changed(zipfp, outpath, members):
+    """
+    Extracts members of zipfp into outpath, skipping the ones whose file on
+    disk is already identical. Skipped files keep their modification times,
+    so build tools don't consider them changed.
+
+    Returns the number of files written.
+    """
+    written = 0
+    for info in members:
+        target = member_path(outpath, info.filename)
+        if info.filename.endswith("/"):
+            os.makedirs(target, exist_ok=True)
+            continue
+        if is_unchanged(info, target):
+            continue
+        write_member(zipfp, info, target)
+        written += 1
+    return written
+
+
+def extract_members(zipfp, outpath, members, jobs=4, large=1024 * 1024,
+                    preserve_times=False):
+    """
+    Extracts members of zipfp into outpath. Members of at least large bytes
+    are decompressed and written on a pool of jobs threads while the small
+    ones are written on this thread.
+    """
+    directories = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for info in members:
+            target = member_path(outpath, info.filename)
+            if info.filename.endswith("/"):
+                os.makedirs(target, exist_ok=True)
+                directories.append((target, info))
+            elif info.file_size >= large:
+                futures.append(executor.submit(write_member, zipfp, info,
+                                               target, preserve_times))
+            else:
+                write_member(zipfp, info, target, preserve_times)
+        for future in futures:
+            future.result()
+
+    if preserve_times:
+        # Writing into a directory changes its mtime, so do the directories
+        # last and the deepest ones first.
+        for target, info in sorted(directories, reverse=True):
+            mtime = member_mtime(info)
+            os.utime(target, (mtime, mtime))
+
+
+@contextmanager
+def staging(outpath, root):
+    """
+    Yields a staging directory inside outpath to build the contents of
+    outpath in, where root is the directory of the exercise. Once the block
+    finishes root is renamed into place in one step, and anything else in
+    the staging directory is moved over file by file. Nothing is moved if
+    the block fails.
+    """
+    os.makedirs(outpath, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=outpath, prefix=".tmc-")
+    try:
+        yield tmpdir
+        staged_root = os.path.join(tmpdir, os.path.relpath(root, outpath))
+        if os.path.isdir(staged_root):
+            os.makedirs(os.path.dirname(root), exist_ok=True)
+            os.rename(staged_root, root)
+        for dirpath, _, files in os.walk(tmpdir):
+            for name in files:
+                source = os.path.join(dirpath, name)
+                target = os.path.join(outpath,
+                                      os.path.relpath(source, tmpdir))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(source, target)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def extract_all(zipfp, outpath, root, jobs=4):
+    """
+    Extracts every member of zipfp into outpath, where root is the directory
+    of the exercise the archive contains.
+
+    If root doesn't exist yet, the archive is built in a staging directory
+    with the timestamps stored in the archive, and root is renamed into
+    place only when everything has been written, so a crash or Ctrl-C never
+    leaves a half extracted exercise behind. Otherwise the members are
+    written over the existing files one at a time.
+    """
+    if os.path.isdir(root):
+        extract_members(zipfp, outpath, zipfp.infolist(), jobs)
+        return
+
+    with staging(outpath, root) as tmpdir:
+        extract_members(zipfp, tmpdir, zipfp.infolist(), jobs,
+                        preserve_times=True)
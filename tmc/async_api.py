@@ -0,0 +1,271 @@
+import asyncio
+import json
+import ssl
+import time
+import uuid
+from urllib.parse import urlencode, urljoin, urlsplit
+
+from tmc.backoff import Backoff, parse_retry_after
+from tmc.cache import PartialDownload
+from tmc.errors import APIError
+
+
+class AsyncAPI(object):
+    """
+    A non-blocking client for the TMC API for commands that make a lot of
+    requests at once.
+
+    Every request runs on a single event loop over its own asyncio
+    connection, and at most limit of them are in flight at a time. Waiting,
+    whether for the server or between submission polls, costs no threads.
+    The server, credentials and circuit breaker are shared with api, but
+    unlike API the requests aren't retried, cached or traced.
+
+        async_api = AsyncAPI(api, limit=16)
+        exercises = async_api.run(
+            [async_api.get_exercises(course) for course in courses])
+    """
+
+    redirects = (301, 302, 303, 307, 308)
+
+    def __init__(self, api, limit=8, timeout=30):
+        self.api = api
+        self.limit = limit
+        self.timeout = timeout
+        self.semaphore = None
+        self.ssl_context = None
+
+    def run(self, coros):
+        """
+        Runs coros concurrently on a new event loop and returns their
+        results in order. A coroutine that raised has the exception as its
+        result.
+        """
+        if not self.api.configured:
+            self.api.configure()
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            self.semaphore = asyncio.Semaphore(self.limit)
+            return loop.run_until_complete(
+                asyncio.gather(*coros, return_exceptions=True))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def get_courses(self):
+        return (await self.get_json("courses.json"))["courses"]
+
+    async def get_exercises(self, course):
+        return (await self.get_json(course.details_url))["course"]["exercises"]
+
+    async def get_zip_stream(self, exercise):
+        """
+        Downloads the zip of exercise into a PartialDownload and returns it.
+        """
+        partial = PartialDownload(self.api.download_dir, exercise.zip_url)
+        with partial.open(0, None, None) as fp:
+            await self.request("GET", exercise.zip_url, fp=fp)
+        return partial
+
+    async def send_zip(self, exercise, file, params):
+        """
+        Sends the zipped submission file for exercise.
+        """
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            "--{0}\r\n"
+            "Content-Disposition: form-data; name=\"commit\"\r\n\r\n"
+            "Submit\r\n"
+            "--{0}\r\n"
+            "Content-Disposition: form-data; name=\"submission[file]\"; "
+            "filename=\"submission.zip\"\r\n"
+            "Content-Type: application/zip\r\n\r\n".format(boundary)
+            .encode("utf-8"),
+            file,
+            "\r\n--{0}--\r\n".format(boundary).encode("utf-8")
+        ])
+        content_type = "multipart/form-data; boundary={0}".format(boundary)
+        _, body = await self.request(
+            "POST", exercise.return_url, params=params, body=body,
+            headers={"Content-Type": content_type})
+        return self._to_json(body)
+
+    async def get_submission(self, url):
+        data, _ = await self.poll_submission(url)
+        return data
+
+    async def poll_submission(self, url):
+        """
+        Fetches a submission once. Like API.poll_submission returns the
+        submission data, or None while it's still processing, and the least
+        amount of seconds to wait before polling again.
+        """
+        headers, body = await self.request("GET", url)
+        data = self._to_json(body)
+        if data["status"] != "processing":
+            return data, 0
+        wait = parse_retry_after(headers.get("retry-after")) or 0
+        queued = data.get("submissions_before_this") or 0
+        return None, max(wait, min(queued * 0.5, 10))
+
+    async def wait_for_submission(self, url, timeout=300):
+        """
+        Polls a submission until it has been processed, backing off the same
+        way as API.wait_for_submission. Returns None if there were no
+        results before the timeout.
+        """
+        deadline = time.time() + timeout
+        backoff = Backoff(initial=0.5, maximum=10)
+        while True:
+            data, wait = await self.poll_submission(url)
+            if data:
+                return data
+            delay = backoff.next(minimum=wait)
+            if time.time() + delay > deadline:
+                return None
+            await asyncio.sleep(delay)
+
+    async def get_json(self, slug):
+        _, body = await self.request("GET", slug)
+        return self._to_json(body)
+
+    async def request(self, method, slug, params=None, headers=None,
+                      body=None, fp=None):
+        """
+        Makes an HTTP request and returns the response headers and body,
+        following redirects. If fp is given the body is written there
+        instead. Fails with an APIError like API does.
+        """
+        url = self.api._make_url(slug)
+        if not self.api.breaker.allow():
+            reason = ("HTTP {0} request to {1} not sent: the TMC server "
+                      "seems to be down, try again later")
+            raise APIError(reason.format(method, url))
+        query = dict(self.api.params, **(params or {}))
+        headers = dict(self.api.auth_header, **(headers or {}))
+        async with self.semaphore:
+            try:
+                for _ in range(5):
+                    status, response_headers, response_body = (
+                        await self._fetch(method, url, query, headers, body,
+                                          fp))
+                    if (status not in self.redirects
+                            or "location" not in response_headers):
+                        break
+                    url = urljoin(url, response_headers["location"])
+                    if status == 303:
+                        method, body = "GET", None
+            except (OSError, ValueError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as e:
+                self.api.breaker.record_failure()
+                reason = "HTTP {0} request to {1} failed: {2}"
+                raise APIError(reason.format(method, url, repr(e)))
+        if status >= 500:
+            self.api.breaker.record_failure()
+        else:
+            self.api.breaker.record_success()
+        if status >= 400:
+            reason = "HTTP {0} request to {1} failed: status {2}"
+            raise APIError(reason.format(method, url, status))
+        return response_headers, response_body
+
+    async def _fetch(self, method, url, query, headers, body, fp):
+        parts = urlsplit(url)
+        https = parts.scheme == "https"
+        context = None
+        if https:
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            context = self.ssl_context
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname,
+                                    parts.port or (443 if https else 80),
+                                    ssl=context),
+            self.timeout)
+        try:
+            target = parts.path or "/"
+            if parts.query or query:
+                target += "?" + "&".join(
+                    q for q in (parts.query, urlencode(query)) if q)
+            lines = ["{0} {1} HTTP/1.1".format(method, target),
+                     "Host: {0}".format(parts.netloc),
+                     "Connection: close",
+                     "Accept-Encoding: identity"]
+            lines += ["{0}: {1}".format(*header) for header in headers.items()]
+            if body is not None:
+                lines.append("Content-Length: {0}".format(len(body)))
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            if body is not None:
+                writer.write(body)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+
+            status, response_headers = await self._read_head(reader)
+            if status in self.redirects:
+                return status, response_headers, b""
+            if status >= 400:
+                fp = None
+            response_body = await self._read_body(reader, response_headers,
+                                                  fp)
+            return status, response_headers, response_body
+        finally:
+            writer.close()
+
+    async def _readline(self, reader):
+        return await asyncio.wait_for(reader.readline(), self.timeout)
+
+    async def _read_head(self, reader):
+        status_line = (await self._readline(reader)).split()
+        if len(status_line) < 2:
+            raise ValueError("Invalid HTTP status line")
+        status = int(status_line[1])
+        headers = {}
+        while True:
+            line = (await self._readline(reader)).decode("latin-1").strip()
+            if not line:
+                return status, headers
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    async def _read_body(self, reader, headers, fp):
+        """
+        Reads a chunked, fixed length or close-delimited body into fp, or
+        returns it if fp is None.
+        """
+        chunks = []
+        write = chunks.append if fp is None else fp.write
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self._readline(reader)).split(b";")[0], 16)
+                if not size:
+                    # Skip the trailers.
+                    while (await self._readline(reader)).strip():
+                        pass
+                    break
+                write(await asyncio.wait_for(reader.readexactly(size),
+                                             self.timeout))
+                await self._readline(reader)
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining:
+                block = await asyncio.wait_for(
+                    reader.read(min(remaining, 64 * 1024)), self.timeout)
+                if not block:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                write(block)
+                remaining -= len(block)
+        else:
+            while True:
+                block = await asyncio.wait_for(reader.read(64 * 1024),
+                                               self.timeout)
+                if not block:
+                    break
+                write(block)
+        return b"".join(chunks)
+
+    def _to_json(self, body):
+        try:
+            return json.loads(body.decode("utf-8"))
+        except ValueError as e:
+            reason = "TMC Server did not send valid JSON: {0}"
+            raise APIError(reason.format(repr(e)))
@@ -0,0 +1,121 @@
+import random
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter.
+
+    Each call to next() returns a delay somewhere between half of and the
+    whole current interval, and then grows the interval by factor up to
+    maximum. The jitter keeps many clients from waking up at the same time.
+    """
+
+    def __init__(self, initial=0.5, maximum=10.0, factor=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.current = initial
+
+    def next(self, minimum=0):
+        """
+        Returns the next delay in seconds, never less than minimum.
+        """
+        delay = random.uniform(self.current / 2, self.current)
+        self.current = min(self.maximum, self.current * self.factor)
+        return max(minimum, delay)
+
+    def reset(self):
+        self.current = self.initial
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, either delta-seconds or an HTTP date, into
+    seconds from now. Returns None if there's no usable value.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed requests are tried again and how many times.
+
+    Only idempotent methods are retried, after connection errors, timeouts
+    and the statuses the server uses when it's busy or temporarily broken.
+    """
+
+    statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, attempts=4, initial=0.5, maximum=8.0,
+                 max_retry_after=60, methods=("GET", "HEAD")):
+        self.attempts = attempts
+        self.initial = initial
+        self.maximum = maximum
+        self.max_retry_after = max_retry_after
+        self.methods = methods
+
+    def applies_to(self, method):
+        return method.upper() in self.methods
+
+    def backoff(self):
+        return Backoff(initial=self.initial, maximum=self.maximum)
+
+    def delay(self, backoff, retry_after=None):
+        """
+        Returns how long to wait before the next attempt, honoring a
+        Retry-After header up to max_retry_after seconds.
+        """
+        wait = parse_retry_after(retry_after) or 0
+        return backoff.next(minimum=min(wait, self.max_retry_after))
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a server that is clearly down.
+
+    After threshold consecutive failed requests the circuit opens and every
+    request fails immediately. Once reset_timeout seconds have passed a
+    single request is let through as a probe. Its success closes the
+    circuit, while its failure keeps the circuit open for another
+    reset_timeout seconds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            # Let this request probe the server and hold back the rest
+            # until the next reset_timeout, in case the probe never reports.
+            self.opened_at = time.time()
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
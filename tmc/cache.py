@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+class ResponseCache(object):
+    """
+    A small on-disk cache for JSON responses from the TMC server.
+
+    Entries are keyed by the request URL and the identity of the user making
+    the request, and they remember the ETag and Last-Modified validators the
+    server sent so that a later request can be made conditional. When the
+    directory grows past max_size bytes the least recently used entries are
+    removed.
+    """
+
+    def __init__(self, directory, max_size=32 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, url, identity):
+        key = hashlib.sha1("{0}\0{1}".format(identity, url).encode("utf-8"))
+        return os.path.join(self.directory, key.hexdigest() + ".json")
+
+    def get(self, url, identity):
+        """
+        Returns the cached entry for url or None. An entry is a dict with the
+        keys "etag", "last_modified" and "body".
+        """
+        path = self._path(url, identity)
+        try:
+            with open(path, "r") as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def touch(self, url, identity):
+        """
+        Marks an entry as recently used.
+        """
+        try:
+            os.utime(self._path(url, identity), None)
+        except OSError:
+            pass
+
+    def put(self, url, identity, headers, body):
+        """
+        Stores body for url if the response had any validators in its headers.
+        """
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        entry = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body
+        }
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0o700)
+            fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as fp:
+                json.dump(entry, fp)
+            os.replace(tmppath, self._path(url, identity))
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        max_size.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        while total > self.max_size and entries:
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class PartialDownload(object):
+    """
+    A download that is kept on disk while it's in progress so that an
+    interrupted transfer can continue where it stopped.
+
+    Next to the partial file a small JSON record remembers the URL, the
+    expected length and the validator (ETag or Last-Modified) that the server
+    sent, which are needed to resume the transfer with a Range request.
+    """
+
+    def __init__(self, directory, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        self.directory = directory
+        self.url = url
+        self.path = os.path.join(directory, key + ".part")
+        self.meta_path = os.path.join(directory, key + ".json")
+        self.length = None
+
+    def resume_point(self):
+        """
+        Returns the offset and validator to resume from, or (0, None) if
+        there's nothing usable on disk.
+        """
+        try:
+            with open(self.meta_path, "r") as fp:
+                meta = json.load(fp)
+            offset = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            return 0, None
+        if meta.get("url") != self.url or not meta.get("validator"):
+            return 0, None
+        length = meta.get("length")
+        if length is not None and offset >= length:
+            # Either finished or garbage, there's nothing left to resume.
+            return 0, None
+        self.length = length
+        return offset, meta["validator"]
+
+    def open(self, offset, length, validator):
+        """
+        Records the metadata of a transfer starting at offset and returns the
+        partial file opened for writing from that offset.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        self.length = length
+        with open(self.meta_path, "w") as fp:
+            json.dump({
+                "url": self.url,
+                "length": length,
+                "validator": validator
+            }, fp)
+        fp = open(self.path, "ab" if offset else "wb")
+        fp.truncate(offset)
+        return fp
+
+    def is_complete(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return False
+        return self.length is None or size == self.length
+
+    def discard(self):
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
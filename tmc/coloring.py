@@ -4,8 +4,12 @@ from sys import stdout, stderr
 from tmc import conf
 
 
-# User might want to disable all coloring
-no_coloring = not conf.use_ansi_colors
+def no_coloring():
+    """
+    User might want to disable all coloring. Asked only when something is
+    printed, so that importing this module doesn't read the configuration.
+    """
+    return not conf.use_ansi_colors
 
 
 class AnsiColorCodes(object):
@@ -27,11 +31,14 @@ to_escaped = lambda x: "\033[{0}m".format(x)
 class Escaped(object):
     """ Helper class for translating AnsiColorCodes (or similar) to escaped"""
     def __init__(self, codes):
-        for item in dir(codes):
-            if item.startswith("_"):
-                continue
-            val = "" if no_coloring else to_escaped(getattr(codes, item))
-            setattr(self, item, val)
+        self._codes = codes
+
+    def __getattr__(self, item):
+        if item.startswith("_"):
+            raise AttributeError(item)
+        val = "" if no_coloring() else to_escaped(getattr(self._codes, item))
+        setattr(self, item, val)
+        return val
 
 
 # Use this to refer to escaped color characters
@@ -40,10 +47,11 @@ Colors = Escaped(AnsiColorCodes)
 
 
 def formatter(color, s):
-    """ Formats a string with color """
-    if no_coloring:
+    """ Formats a string with color, given by its name in AnsiColorCodes """
+    if no_coloring():
         return s
-    return "{begin}{s}{reset}".format(begin=color, s=s, reset=Colors.RESET)
+    return "{begin}{s}{reset}".format(begin=getattr(Colors, color), s=s,
+                                      reset=Colors.RESET)
 
 
 class Printer(object):
@@ -77,17 +85,28 @@ class Printer(object):
 
 # Use one of these to print multiple lines in a specific
 # color context.
-ErrorPrinter = partial(Printer, Colors.RED, stderr)
-WarningPrinter = partial(Printer, Colors.YELLOW, stderr)
-SuccessPrinter = partial(Printer, Colors.GREEN, stdout)
-InfoPrinter = partial(Printer, Colors.CYAN, stdout)
+def ErrorPrinter():
+    return Printer(Colors.RED, stderr)
+
+
+def WarningPrinter():
+    return Printer(Colors.YELLOW, stderr)
+
+
+def SuccessPrinter():
+    return Printer(Colors.GREEN, stdout)
+
+
+def InfoPrinter():
+    return Printer(Colors.CYAN, stdout)
+
 
 # These are useful is you have only a few lines you want
 # to print with specific color context
-as_error = partial(formatter, Colors.RED)
-as_warning = partial(formatter, Colors.YELLOW)
-as_success = partial(formatter, Colors.GREEN)
-as_info = partial(formatter, Colors.CYAN)
+as_error = partial(formatter, "RED")
+as_warning = partial(formatter, "YELLOW")
+as_success = partial(formatter, "GREEN")
+as_info = partial(formatter, "CYAN")
 
 
 # Identical to print() but with support for output coloring
@@ -18,11 +18,21 @@ class Config(object):
     config = None
     filename = ""
     defaults = None
+    loaded = False
 
     def __init__(self):
         default_path = path.join(path.expanduser("~"), ".config", "tmc.ini")
         config_filepath = environ.get("TMC_CONFIGFILE", default_path)
         super().__setattr__('filename', config_filepath)
+
+    def _ensure_loaded(self):
+        """
+        Reads the configuration the first time it's needed. The file is only
+        written when it's missing or lacks some of the options, and every
+        value is parsed once and then cached as a plain attribute.
+        """
+        if self.loaded:
+            return
         super().__setattr__('config', ConfigParser())
         self._update_defaults()
 
@@ -30,10 +40,23 @@ class Config(object):
 
         for i in self.defaults:
             self.config["CONFIGURATION"][i] = str(self.defaults[i])
+        missing = set(self.defaults)
         if self._exists():
-            self._load()
+            missing -= self._load()
+
+        if missing:
+            self._write()
+
+        for name in self.config["CONFIGURATION"]:
+            self._cache(name)
+        super().__setattr__('loaded', True)
 
-        self._write()
+    def _cache(self, name):
+        if isinstance(self.defaults.get(name), bool):
+            value = self.config["CONFIGURATION"].getboolean(name)
+        else:
+            value = self.config["CONFIGURATION"].get(name)
+        super().__setattr__(name, value)
 
     def _update_defaults(self):
         defaults = OrderedDict()
@@ -60,16 +83,29 @@ class Config(object):
             self.config.write(fp)
 
     def _load(self):
+        """
+        Reads the configuration file and returns the options it had.
+        """
+        parser = ConfigParser()
         with open(self.filename, "r") as fp:
-            self.config.read_file(fp)
-        for i in self.config["CONFIGURATION"]:
+            parser.read_file(fp)
+        self.config.read_dict(parser)
+        found = set()
+        if parser.has_section("CONFIGURATION"):
+            found = set(parser["CONFIGURATION"])
+        for i in found:
             if i not in self.defaults:
                 print("Warning: unknown configuration option: " + i)
+        return found
 
     def __getattr__(self, name):
-        if isinstance(self.defaults.get(name), bool):
-            return self.config["CONFIGURATION"].getboolean(name)
-        return self.config["CONFIGURATION"].get(name)
+        # Only called for values that haven't been cached yet.
+        if self.loaded:
+            return None
+        self._ensure_loaded()
+        return getattr(self, name)
 
     def __setattr__(self, name, value):
+        self._ensure_loaded()
         self.config["CONFIGURATION"][name] = str(value)
+        self._cache(name)
@@ -1,9 +1,11 @@
+import hashlib
 import os
-import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 from tmc import api, conf
+from tmc.archive import extract_all, extract_changed
 from tmc.errors import NotDownloaded, TMCError, WrongExerciseType
 from tmc.ui.spinner import Spinner
 from tmc.coloring import successmsg, warningmsg, errormsg, infomsg
@@ -18,6 +20,7 @@ def download_exercise(exercise, force=False, update_java=False, update=False):
     if not force and os.path.isdir(realoutpath) and not update:
         print("Already downloaded, skipping.")
         exercise.is_downloaded = True
+        record_fingerprint(exercise, realoutpath)
         exercise.save()
         if update_java:
             try:
@@ -28,16 +31,12 @@ def download_exercise(exercise, force=False, update_java=False, update=False):
 
     with Spinner.context(msg="Updated." if needs_update else "Downloaded.",
                          waitmsg="Downloading."):
-        tmpfile = BytesIO()
-        api.get_zip_stream(exercise, tmpfile)
-        zipfp = zipfile.ZipFile(tmpfile)
-        if needs_update:
-            for i in zipfp.infolist():
-                if "/src/" not in i.filename:
-                    zipfp.extract(i, outpath)
-        else:
-            zipfp.extractall(outpath)
+        fetch_exercise(exercise, outpath, realoutpath, needs_update)
         exercise.is_downloaded = True
+        exercise.downloaded_checksum = exercise.checksum
+        if not needs_update:
+            exercise.src_fingerprint = src_fingerprint(
+                os.path.join(realoutpath, "src"))
         exercise.save()
 
     if update_java:
@@ -47,6 +46,116 @@ def download_exercise(exercise, force=False, update_java=False, update=False):
             pass
 
 
+def fetch_exercise(exercise, outpath, realoutpath, needs_update=False):
+    """
+    Extracts the zip of exercise into outpath, realoutpath being the
+    directory of the exercise itself. The zip comes from the exercise store
+    when it's there and is downloaded into it otherwise. A new exercise is
+    checked out from the blobs of the store, when updating only files
+    outside of /src/ that differ from the ones on disk are written. The
+    store is only a cache, if it fails the zip is downloaded and extracted
+    as usual. Touches neither the database nor the output once api is
+    configured, so it's safe to run on a worker thread.
+    """
+    store = api.store
+    key = exercise.checksum if store.valid_key(exercise.checksum) else None
+    path = store.archive(key) if key else None
+    partial = None
+    try:
+        if path is None:
+            partial = api.get_zip_stream(exercise)
+            path = partial.path
+            if key:
+                try:
+                    path = store.add(key, partial.path)
+                except OSError:
+                    key = None
+        if key and not needs_update and not os.path.isdir(realoutpath):
+            try:
+                if store.checkout(key, outpath, realoutpath):
+                    return
+            except OSError:
+                pass
+        with zipfile.ZipFile(path) as zipfp:
+            if needs_update:
+                extract_changed(zipfp, outpath,
+                                [i for i in zipfp.infolist()
+                                 if "/src/" not in i.filename])
+            else:
+                extract_all(zipfp, outpath, realoutpath)
+    finally:
+        if partial is not None:
+            partial.discard()
+
+
+def download_exercises(exercises, jobs=4, force=False, update_java=False,
+                       update=False):
+    """
+    Downloads many exercises using a pool of jobs worker threads. Only the
+    fetching and extracting happens on the workers, results are printed and
+    saved to the database on this thread in the order of exercises. A failed
+    exercise is reported and the rest of the batch continues.
+
+    Returns the number of exercises that failed.
+    """
+    pending = []
+    failed = 0
+    # Configuring reads and writes the database, so do it here instead of
+    # letting the first request on every worker thread do it.
+    if not api.configured:
+        api.configure()
+    with ThreadPoolExecutor(max_workers=worker_count(jobs)) as executor:
+        for exercise in exercises:
+            outpath = exercise.get_course().path
+            realoutpath = exercise.path()
+            needs_update = update and exercise.is_downloaded
+            future = None
+            if force or not os.path.isdir(realoutpath) or update:
+                future = executor.submit(fetch_exercise, exercise, outpath,
+                                         realoutpath, needs_update)
+            pending.append((exercise, realoutpath, needs_update, future))
+
+        for exercise, realoutpath, needs_update, future in pending:
+            print("{} -> {}".format(exercise.menuname(), realoutpath))
+            if future is None:
+                print("Already downloaded, skipping.")
+                record_fingerprint(exercise, realoutpath)
+            else:
+                try:
+                    future.result()
+                except TMCError as e:
+                    print(e)
+                    failed += 1
+                    continue
+                except (OSError, zipfile.BadZipFile) as e:
+                    errormsg("Extracting failed: {0}".format(e))
+                    failed += 1
+                    continue
+                print("Updated." if needs_update else "Downloaded.")
+                exercise.downloaded_checksum = exercise.checksum
+                if not needs_update:
+                    exercise.src_fingerprint = src_fingerprint(
+                        os.path.join(realoutpath, "src"))
+            exercise.is_downloaded = True
+            exercise.save()
+            if update_java:
+                try:
+                    modify_java_target(exercise)
+                except TMCError:
+                    pass
+    return failed
+
+
+def worker_count(jobs, default=4):
+    """
+    The number of worker threads to use for a --jobs value, which is None
+    when it wasn't given.
+    """
+    if jobs is None:
+        return default
+    return max(1, jobs)
+
+
 def modify_java_target(exercise, old="1.6", new="1.7"):
     path = os.path.join(exercise.path(), "nbproject", "project.properties")
     if not os.path.isfile(path):
@@ -62,7 +171,81 @@ def modify_java_target(exercise, old="1.6", new="1.7"):
     print("Changed Java target from {} to {}".format(old, new))
 
 
-def submit_exercise(exercise, request_review=False, pastebin=False):
+def submission_params(request_review=False, pastebin=False):
+    params = {}
+    if request_review:
+        params["request_review"] = "wolololo"
+    if pastebin:
+        params["paste"] = "wolololo"
+    return params
+
+
+def src_fingerprint(srcpath):
+    """
+    Returns a fingerprint of the names, sizes and modification times of the
+    files in srcpath. It changes whenever a file there is edited.
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(srcpath):
+        dirs.sort()
+        for file in sorted(files):
+            filename = os.path.join(root, file)
+            stat = os.stat(filename)
+            digest.update("{0}\0{1}\0{2}\0".format(
+                os.path.relpath(filename, srcpath), stat.st_size,
+                stat.st_mtime).encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def record_fingerprint(exercise, realoutpath):
+    """
+    Gives an exercise that was downloaded without one, for example by an
+    older version, a fingerprint of its src directory as it is now.
+    """
+    srcpath = os.path.join(realoutpath, "src")
+    if not exercise.src_fingerprint and os.path.isdir(srcpath):
+        exercise.src_fingerprint = src_fingerprint(srcpath)
+
+
+def has_changed(exercise):
+    """
+    Has the src directory of exercise changed since it was last downloaded
+    or submitted. Returns None for exercises without a fingerprint, since
+    there's nothing to compare them to.
+    """
+    srcpath = os.path.join(exercise.path(), "src")
+    if not os.path.isdir(srcpath):
+        return False
+    if not exercise.src_fingerprint:
+        return None
+    return src_fingerprint(srcpath) != exercise.src_fingerprint
+
+
+def zip_source(srcpath):
+    """
+    Returns the contents of srcpath zipped up for a submission.
+    """
+    tmpfile = BytesIO()
+    with zipfile.ZipFile(tmpfile, "w") as zipfp:
+        for root, _, files in os.walk(srcpath):
+            for file in files:
+                filename = os.path.join(root, file)
+                archname = os.path.relpath(os.path.join(root, file),
+                                           os.path.join(srcpath, '..'))
+                compress_type = zipfile.ZIP_DEFLATED
+                zipfp.write(filename, archname, compress_type)
+    return tmpfile.getvalue()
+
+
+def send_exercise(exercise, srcpath, params):
+    """
+    Zips srcpath and sends it to the server as a submission of exercise.
+    """
+    return api.send_zip(exercise, zip_source(srcpath), params)
+
+
+def submit_exercise(exercise, request_review=False, pastebin=False,
+                    timeout=300):
     outpath = exercise.path()
     infomsg("Submitting from:", outpath)
     print("{} -> {}".format(exercise.menuname(), "TMC Server"))
@@ -72,40 +255,25 @@ def submit_exercise(exercise, request_review=False, pastebin=False):
     exercise.is_downloaded = True
     exercise.save()
 
-    params = {}
-    if request_review:
-        params["request_review"] = "wolololo"
-    if pastebin:
-        params["paste"] = "wolololo"
+    params = submission_params(request_review, pastebin)
 
     resp = None
 
     with Spinner.context(msg="Submission has been sent.",
                          waitmsg="Sending submission."):
-        tmpfile = BytesIO()
-        with zipfile.ZipFile(tmpfile, "w") as zipfp:
-            for root, _, files in os.walk(outpath):
-                for file in files:
-                    filename = os.path.join(root, file)
-                    archname = os.path.relpath(os.path.join(root, file),
-                                               os.path.join(outpath, '..'))
-                    compress_type = zipfile.ZIP_DEFLATED
-                    zipfp.write(filename, archname, compress_type)
-
-        resp = api.send_zip(exercise, tmpfile.getvalue(), params)
+        resp = send_exercise(exercise, outpath, params)
 
     if "submission_url" not in resp:
         return
 
+    exercise.src_fingerprint = src_fingerprint(outpath)
+    exercise.save()
+
     url = resp["submission_url"]
 
     @Spinner.decorate(msg="Results:", waitmsg="Waiting for results.")
     def inner():
-        while True:
-            data = api.get_submission(url)
-            if data:
-                return data
-            time.sleep(1)
+        return api.wait_for_submission(url, timeout=timeout)
     data = inner()
 
     success = True
@@ -155,3 +323,88 @@ def submit_exercise(exercise, request_review=False, pastebin=False):
 
     if not success:
         return False
+
+
+def submit_exercises(exercises, jobs=4, request_review=False, pastebin=False,
+                     timeout=300):
+    """
+    Submits many exercises at once. The exercises are zipped here and sent
+    concurrently on an event loop with at most jobs requests in flight,
+    after which all of the submissions are polled together and the results
+    are summarized in a single table.
+
+    Returns False if any of the exercises didn't pass.
+    """
+    from tmc.async_api import AsyncAPI
+
+    params = submission_params(request_review, pastebin)
+    async_api = AsyncAPI(api, limit=worker_count(jobs))
+    rows = {}
+    pending = []
+    submitted = []
+    with Spinner.context(msg="Submissions have been sent.",
+                         waitmsg="Sending submissions."):
+        for exercise in exercises:
+            srcpath = os.path.join(exercise.path(), "src")
+            if not os.path.isdir(srcpath):
+                rows[exercise.tid] = "not downloaded"
+                continue
+            pending.append((exercise, srcpath, zip_source(srcpath)))
+
+        responses = async_api.run([async_api.send_zip(exercise, data, params)
+                                   for exercise, _, data in pending])
+        for (exercise, srcpath, _), resp in zip(pending, responses):
+            if isinstance(resp, TMCError):
+                rows[exercise.tid] = "error: {0}".format(resp.value)
+                continue
+            if isinstance(resp, Exception):
+                raise resp
+            if "submission_url" not in resp:
+                rows[exercise.tid] = "not accepted"
+                continue
+            exercise.is_downloaded = True
+            exercise.src_fingerprint = src_fingerprint(srcpath)
+            exercise.save()
+            submitted.append((exercise, resp["submission_url"]))
+
+    @Spinner.decorate(msg="Results:", waitmsg="Waiting for results.")
+    def inner():
+        return async_api.run([async_api.wait_for_submission(url, timeout)
+                              for _, url in submitted])
+    results = {}
+    for (_, url), data in zip(submitted, inner()):
+        if isinstance(data, TMCError):
+            data = {"status": "error", "error": data.value}
+        elif isinstance(data, Exception):
+            raise data
+        results[url] = data
+
+    urls = dict((exercise.tid, url) for exercise, url in submitted)
+    success = True
+    print("ID{0}│ Status │ Points │ Name".format(
+        (len(str(max(ex.tid for ex in exercises))) - 1) * " "))
+    for exercise in exercises:
+        data = results.get(urls.get(exercise.tid))
+        points = ""
+        if exercise.tid in rows:
+            status = rows[exercise.tid]
+        elif data is None:
+            status = "timed out"
+        else:
+            status = data["status"]
+            points = ", ".join(data.get("points", []))
+            if status == "ok":
+                exercise.is_completed = exercise.is_attempted = True
+                exercise.save()
+        line = "{0} │ {1:6} │ {2:6} │ {3}".format(
+            exercise.tid, status, points, exercise.menuname())
+        if status == "ok":
+            successmsg(line)
+        else:
+            errormsg(line)
+            success = False
+        if data and data.get("paste_url"):
+            infomsg("  Pastebin URL: " + data["paste_url"])
+
+    if not success:
+        return False
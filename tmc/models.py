@@ -1,11 +1,17 @@
 import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
 
 from peewee import (BooleanField, CharField, DateField, ForeignKeyField,
                     IntegerField, Model, SqliteDatabase, DoesNotExist,
-                    OperationalError)
+                    OperationalError, fn)
 from playhouse.migrate import SqliteMigrator
 from playhouse.migrate import migrate as run_migrate
 
+from tmc.backoff import Backoff
 from tmc.errors import NoCourseSelected, NoExerciseSelected
 
 target_file = os.environ.get("TMC_DATABASEFILE",
@@ -13,12 +19,174 @@ target_file = os.environ.get("TMC_DATABASEFILE",
                                           ".config",
                                           "tmc.db"))
 
-# SqliteDatabase will fail if the parent directory isn't there.
-if not os.path.isdir(os.path.dirname(target_file)):
-    os.mkdir(os.path.dirname(target_file), 0o700)
 
-sqlite = SqliteDatabase(target_file)
-sqlite.connect()
+class Database(SqliteDatabase):
+    """
+    The tmc.db store. Nothing is opened until a query is made, and the first
+    connection of the process also makes sure the schema is up to date. The
+    schema version is kept in SQLite's user_version so that checking it costs
+    a single PRAGMA.
+    """
+
+    pragmas = (
+        ("busy_timeout", 5000),
+        ("cache_size", -4096),
+    )
+
+    # WAL needs shared memory, which doesn't work on network file systems
+    # like the NFS home directories of lab machines.
+    network_filesystems = ("nfs", "nfs4", "cifs", "smbfs", "smb3", "afs",
+                           "9p", "fuse.sshfs")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initialized = False
+        self.init_lock = threading.Lock()
+
+    def _connect(self, database, **kwargs):
+        # SqliteDatabase will fail if the parent directory isn't there.
+        if not os.path.isdir(os.path.dirname(database)):
+            os.mkdir(os.path.dirname(database), 0o700)
+        conn = super()._connect(database, **kwargs)
+        for name, value in self.pragmas:
+            conn.execute("PRAGMA {0} = {1}".format(name, value))
+        self._set_journal_mode(conn, database)
+        return conn
+
+    def _set_journal_mode(self, conn, database):
+        """
+        Uses WAL, where readers and the writer don't block each other,
+        unless TMC_JOURNAL_MODE says otherwise or the database is on a
+        network file system. If WAL can't be set up SQLite's default
+        rollback journal is used instead.
+        """
+        mode = os.environ.get("TMC_JOURNAL_MODE", "").lower()
+        if not mode:
+            mode = "delete" if self._on_network_fs(database) else "wal"
+        try:
+            mode = conn.execute(
+                "PRAGMA journal_mode = {0}".format(mode)).fetchone()[0]
+        except sqlite3.Error:
+            mode = conn.execute(
+                "PRAGMA journal_mode = delete").fetchone()[0]
+        if mode == "wal":
+            conn.execute("PRAGMA synchronous = normal")
+            conn.execute("PRAGMA mmap_size = {0}".format(16 * 1024 * 1024))
+
+    def _on_network_fs(self, database):
+        """
+        Is database on a network file system according to the mount table.
+        Only knows about Linux, everything else counts as local.
+        """
+        try:
+            with open("/proc/self/mounts") as fp:
+                mounts = [line.split()[1:3] for line in fp]
+        except OSError:
+            return False
+        directory = os.path.realpath(os.path.dirname(database))
+        fstype = None
+        longest = -1
+        for mountpoint, kind in mounts:
+            mountpoint = mountpoint.replace("\\040", " ")
+            inside = (directory == mountpoint or directory.startswith(
+                mountpoint.rstrip("/") + "/"))
+            if inside and len(mountpoint) > longest:
+                fstype, longest = kind, len(mountpoint)
+        return fstype in self.network_filesystems
+
+    def begin(self, *args, **kwargs):
+        # Take the write lock when the transaction starts. A deferred
+        # transaction that reads first can't get the lock later on if another
+        # process has written in between, and fails instead of waiting.
+        self.execute_sql("BEGIN IMMEDIATE", require_commit=False)
+
+    def connect(self):
+        super().connect()
+        with self.init_lock:
+            if not self.initialized:
+                self.ensure_schema()
+                self.initialized = True
+
+    def ensure_schema(self):
+        """
+        Creates and migrates the schema, unless user_version already says
+        that it's up to date, which is the case on all but the first run
+        after an install or an upgrade.
+        """
+        if self.schema_version() >= len(migrations):
+            return
+        # Another process might be doing this at the same time, so check
+        # again once we hold the write lock.
+        with self.transaction():
+            if self.schema_version() >= len(migrations):
+                return
+            init_db()
+            migrate()
+            self.execute_sql("PRAGMA user_version = {0}".format(
+                len(migrations)))
+
+    def schema_version(self):
+        return self.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+sqlite = Database(target_file)
+
+
+def write_transaction(func):
+    """
+    Runs func in a transaction of its own, so that its writes are atomic and
+    hold the write lock only for a short while. If another process keeps the
+    database locked for longer than the busy timeout, func is retried a few
+    times. Inside another transaction func just joins that one.
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if sqlite.transaction_depth() > 0:
+            return func(*args, **kwargs)
+        backoff = Backoff(initial=0.1, maximum=1)
+        attempts = 3
+        for attempt in range(1, attempts + 1):
+            try:
+                with sqlite.transaction():
+                    return func(*args, **kwargs)
+            except OperationalError as e:
+                if "locked" not in str(e) or attempt == attempts:
+                    raise
+                time.sleep(backoff.next())
+    return inner
+
+
+class RowCache(object):
+    """
+    An identity map of the rows loaded in this process, so that a row is
+    queried at most once per command no matter how many other rows refer to
+    it. Saving a row through its model refreshes the cached row, bulk
+    updates have to invalidate the rows of their model.
+    """
+
+    def __init__(self):
+        self.rows = {}
+
+    def get(self, model, pk):
+        key = (model, pk)
+        row = self.rows.get(key)
+        if row is None:
+            row = model.get(model._meta.primary_key == pk)
+            self.rows[key] = row
+        return row
+
+    def put(self, row):
+        self.rows[(type(row), row._get_pk_value())] = row
+
+    def invalidate(self, model=None):
+        if model is None:
+            self.rows.clear()
+            return
+        for key in [key for key in self.rows if key[0] is model]:
+            del self.rows[key]
+
+
+row_cache = RowCache()
 
 
 class BaseModel(Model):
@@ -26,6 +194,19 @@ class BaseModel(Model):
     class Meta:
         database = sqlite
 
+    @classmethod
+    def cached(cls, pk):
+        """
+        Returns the row with primary key pk, querying it only if it hasn't
+        been loaded already.
+        """
+        return row_cache.get(cls, pk)
+
+    def save(self, *args, **kwargs):
+        ret = super().save(*args, **kwargs)
+        row_cache.put(self)
+        return ret
+
 
 class SchemaVersion(BaseModel):
     version = IntegerField()
@@ -34,14 +215,16 @@ class SchemaVersion(BaseModel):
 class Course(BaseModel):
     tid = IntegerField(unique=True)
     name = CharField()
-    is_selected = BooleanField(default=False)
+    is_selected = BooleanField(default=False, index=True)
     path = CharField(default="")
     details_url = CharField()
 
+    @write_transaction
     def set_select(self):
         Course.update(
             is_selected=False
         ).where(Course.is_selected == True).execute()
+        row_cache.invalidate(Course)
         self.is_selected = True
         self.save()
 
@@ -61,12 +244,70 @@ class Course(BaseModel):
     def menuname(self):
         return self.name
 
+    @write_transaction
+    def set_path(self, path):
+        """
+        Changes the download path of the course and the indexed paths of its
+        exercises along with it.
+        """
+        self.path = path
+        self.save()
+        self.update_local_paths()
+
+    def update_local_paths(self):
+        # Only the needed columns are touched, this also runs in migrations.
+        query = Exercise.select(Exercise.id, Exercise.name).where(
+            Exercise.course == self.id)
+        for ex in query:
+            Exercise.update(local_path=local_path(self, ex.name)).where(
+                Exercise.id == ex.id).execute()
+        row_cache.invalidate(Exercise)
+
+    @staticmethod
+    def sync(courses):
+        """
+        Brings the courses up to date with the course data from the server.
+        The changes are worked out with reads only, and the write lock is
+        taken only if there's something to write.
+        """
+        if any(Course._changes(courses)):
+            Course._write_changes(courses)
+
+    @staticmethod
+    @write_transaction
+    def _write_changes(courses):
+        # Another process may have synced in between, so look again now that
+        # we hold the lock.
+        new_rows, updates = Course._changes(courses)
+        update_rows(Course, updates)
+        insert_rows(Course, new_rows)
+        row_cache.invalidate(Course)
+
+    @staticmethod
+    def _changes(courses):
+        """
+        Returns the rows to insert and the changed columns of the existing
+        rows by their ID.
+        """
+        existing = dict((course.tid, course) for course in Course.select())
+        new_rows = []
+        updates = {}
+        for data in courses:
+            old = existing.get(data["id"])
+            if old is None:
+                new_rows.append({"tid": data["id"],
+                                 "name": data["name"],
+                                 "details_url": data["details_url"]})
+            elif old.details_url != data["details_url"]:
+                updates[old.id] = {"details_url": data["details_url"]}
+        return new_rows, updates
+
 
 class Exercise(BaseModel):
     tid = IntegerField(unique=True)
     name = CharField()
     course = ForeignKeyField(Course, related_name="exercises")
-    is_selected = BooleanField(default=False)
+    is_selected = BooleanField(default=False, index=True)
     is_completed = BooleanField(default=False)
     is_downloaded = BooleanField(default=False)
     is_attempted = BooleanField(default=False)
@@ -76,42 +317,66 @@ class Exercise(BaseModel):
     zip_url = CharField(default='')
     return_url = CharField(default='')
 
+    # Fingerprint of the src directory when it was last downloaded or
+    # submitted, used to find exercises that have been worked on since.
+    src_fingerprint = CharField(default='')
+
+    # Normalized absolute path of the exercise, indexed so that the current
+    # directory can be resolved to an exercise with a single query.
+    local_path = CharField(default='', index=True)
+
+    # menuname() of the exercise, precomputed when syncing.
+    display_name = CharField(default='')
+
+    # Checksum of the exercise template on the server, and of the template
+    # the local files were last downloaded from.
+    checksum = CharField(default='')
+    downloaded_checksum = CharField(default='')
+
     def get_course(self):
-        return Course.get(Course.id == self.course)
+        return Course.cached(self._data["course"])
 
     def path(self):
-        course = Course.get(Course.id == self.course)
-        return os.path.join(course.path, "/".join(self.name.split("-")))
+        return exercise_path(self.get_course(), self.name)
 
+    @write_transaction
     def set_select(self):
         Exercise.update(is_selected=False).where(
             Exercise.is_selected == True).execute()
+        row_cache.invalidate(Exercise)
         self.is_selected = True
-        self.course.set_select()
+        self.get_course().set_select()
         self.save()
 
+    def is_outdated(self):
+        """
+        Has the template of the exercise changed on the server since it was
+        downloaded. Without a checksum from the server it's assumed to have.
+        """
+        return not self.checksum or self.checksum != self.downloaded_checksum
+
     def update_downloaded(self):
-        self.is_downloaded = os.path.isdir(self.path())
-        self.save()
+        is_downloaded = os.path.isdir(self.path())
+        if is_downloaded != self.is_downloaded:
+            self.is_downloaded = is_downloaded
+            self.save()
 
     @staticmethod
     def get_selected():
-        sel = None
-        path = os.getcwd()
-        path = path.split("/")
-        for course in Course.select().where(Course.path != "").execute():
-            cpath = course.path.split("/")
-            if path[:len(cpath)] == cpath:
-                for ex in course.exercises.where(Exercise.is_downloaded == True):
-                    epath = ex.path().split("/")
-                    if path[:len(epath)] == epath:
-                        sel = ex
-                        ex.set_select()
-                        print("Selected", "\"{}\"".format(ex.menuname()),
-                              "based on the current directory.")
-                        break
-                if sel:
-                    break
+        # The exercise we are in is the one whose path is the current
+        # directory or one of its parents.
+        path = os.path.normpath(os.getcwd())
+        parents = [path]
+        while os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+            parents.append(path)
+        sel = Exercise.select().where(
+            (Exercise.local_path << parents) & (Exercise.is_downloaded == True)
+        ).order_by(fn.Length(Exercise.local_path).desc()).first()
+        if sel and not (sel.is_selected and sel.get_course().is_selected):
+            sel.set_select()
+            print("Selected", "\"{}\"".format(sel.menuname()),
+                  "based on the current directory.")
 
         if not sel:
             sel = Exercise.select().where(Exercise.is_selected == True).first()
@@ -123,6 +388,72 @@ class Exercise(BaseModel):
     def byid(id):
         return Exercise.get(Exercise.tid == int(id))
 
+    @staticmethod
+    def sync(course, exercises):
+        """
+        Brings the exercises up to date with the exercise data of course from
+        the server. The changes are worked out with reads only, and the write
+        lock is taken only if there's something to write. Returns the
+        downloaded exercises whose template has changed since they were
+        downloaded.
+        """
+        new_rows, updates, outdated = Exercise._changes(course, exercises)
+        if new_rows or updates:
+            Exercise._write_changes(course, exercises)
+        return outdated
+
+    @staticmethod
+    @write_transaction
+    def _write_changes(course, exercises):
+        # Another process may have synced in between, so look again now that
+        # we hold the lock.
+        new_rows, updates, _ = Exercise._changes(course, exercises)
+        update_rows(Exercise, updates)
+        insert_rows(Exercise, new_rows)
+        row_cache.invalidate(Exercise)
+
+    @staticmethod
+    def _changes(course, exercises):
+        """
+        Returns the rows to insert, the changed columns of the existing rows
+        by their ID and the outdated exercises. The outdated exercises
+        already have the new values, unsaved.
+        """
+        existing = dict((ex.tid, ex) for ex in Exercise.select())
+        new_rows = []
+        updates = {}
+        outdated = []
+        for data in exercises:
+            fields = {
+                "name": data["name"],
+                "course": course.id,
+                "is_attempted": data["attempted"],
+                "is_completed": data["completed"],
+                "deadline": data.get("deadline"),
+                "return_url": data["return_url"],
+                "zip_url": data["zip_url"],
+                "submissions_url": data["exercise_submissions_url"],
+                "checksum": data.get("checksum", "")
+            }
+            fields["is_downloaded"] = os.path.isdir(
+                exercise_path(course, data["name"]))
+            fields["local_path"] = local_path(course, data["name"])
+            fields["display_name"] = display_name(data["name"])
+            old = existing.get(data["id"])
+            if old is None:
+                fields["tid"] = data["id"]
+                new_rows.append(fields)
+                continue
+            changed = dict((name, value) for name, value in fields.items()
+                           if old._data.get(name) != value)
+            if changed:
+                updates[old.id] = changed
+                for name, value in changed.items():
+                    setattr(old, name, value)
+            if old.is_downloaded and old.is_outdated():
+                outdated.append(old)
+        return new_rows, updates, outdated
+
     def __str__(self):
         return "Exercise \"{}\" (ID {})".format(self.name, self.tid)
 
@@ -130,27 +461,104 @@ class Exercise(BaseModel):
         return str(self)
 
     def menuname(self):
-        short, rest = "", ""
-        if "-" in self.name:
-            rest = self.name.split("-")[-1]
-        else:
-            rest = self.name
-        if "." in rest:
-            split = rest.split(".")
-            short = split[-1]
-            rest = ".".join(split[0:-1])
-        realname = ""
-        for c in short:
-            if c.isupper():
-                if len(realname) == 0:
-                    realname += c
-                else:
-                    realname += " " + c
-            else:
+        return self.display_name or display_name(self.name)
+
+    @staticmethod
+    def rows(course):
+        """
+        Lists the exercises of course as lightweight ExerciseRows with only
+        the columns needed for listing them.
+        """
+        query = Exercise.select(Exercise.tid, Exercise.is_selected,
+                                Exercise.is_downloaded, Exercise.is_completed,
+                                Exercise.display_name).where(
+            Exercise.course == course.id).order_by(Exercise.id)
+        return [ExerciseRow(*row) for row in query.tuples()]
+
+
+class ExerciseRow(namedtuple("ExerciseRow", [
+        "tid", "is_selected", "is_downloaded", "is_completed",
+        "display_name"])):
+    """
+    The columns of an Exercise needed to list it, for listings and menus
+    that would otherwise build a whole model instance per exercise.
+    """
+    __slots__ = ()
+
+    def menuname(self):
+        return self.display_name
+
+
+def display_name(name):
+    """
+    Turns the name of an exercise into a more readable one. These are
+    computed when syncing and stored in Exercise.display_name.
+    """
+    short, rest = "", ""
+    if "-" in name:
+        rest = name.split("-")[-1]
+    else:
+        rest = name
+    if "." in rest:
+        split = rest.split(".")
+        short = split[-1]
+        rest = ".".join(split[0:-1])
+    realname = ""
+    for c in short:
+        if c.isupper():
+            if len(realname) == 0:
                 realname += c
-        if len(realname) > 0:
-            return rest.replace("_", " - ") + " - " + realname
-        return self.name
+            else:
+                realname += " " + c
+        else:
+            realname += c
+    if len(realname) > 0:
+        return rest.replace("_", " - ") + " - " + realname
+    return name
+
+
+def exercise_path(course, name):
+    return os.path.join(course.path, "/".join(name.split("-")))
+
+
+def local_path(course, name):
+    """
+    The path of an exercise as it is stored in the path index. Exercises of
+    courses without a download path aren't indexed.
+    """
+    if not course.path:
+        return ""
+    return os.path.normpath(exercise_path(course, name))
+
+
+def insert_rows(model, rows, batch_size=50):
+    """
+    Inserts rows with multi-row INSERTs, batch_size rows at a time so that
+    SQLite's limit on the number of bound parameters isn't hit. Fields
+    missing from a row get their default values.
+    """
+    defaults = dict((name, field.default)
+                    for name, field in model._meta.fields.items()
+                    if field.default is not None)
+    rows = [dict(defaults, **row) for row in rows]
+    for start in range(0, len(rows), batch_size):
+        model.insert_many(rows[start:start + batch_size]).execute()
+
+
+def update_rows(model, updates, batch_size=500):
+    """
+    Writes only the changed columns of existing rows, given as a dict from
+    primary key to the changed columns. Rows with the same changes, like a
+    batch of newly completed exercises, are updated with a single query.
+    """
+    groups = {}
+    for pk, fields in updates.items():
+        groups.setdefault(tuple(sorted(fields.items())), []).append(pk)
+    for fields, pks in groups.items():
+        for start in range(0, len(pks), batch_size):
+            model.update(**dict(fields)).where(
+                model._meta.primary_key << pks[start:start + batch_size]
+            ).execute()
 
 
 class Config(BaseModel):
@@ -159,6 +567,18 @@ class Config(BaseModel):
 
     @staticmethod
     def set(name, value):
+        # Most of the time the value is already there, so don't take the
+        # write lock just to find that out.
+        try:
+            if Config.get_value(name) == str(value):
+                return
+        except DoesNotExist:
+            pass
+        Config._write(name, value)
+
+    @staticmethod
+    @write_transaction
+    def _write(name, value):
         try:
             old = Config.get(Config.name == name)
             old.value = value
@@ -195,13 +615,55 @@ def migrate_0_to_1(migrator):
         migrator.add_column('exercise', 'submissions_url', CharField(default=""))
     )
 
-migrations = [migrate_0_to_1]
+
+def migrate_1_to_2(migrator):
+    run_migrate(
+        migrator.add_column('exercise', 'src_fingerprint',
+                            CharField(default=""))
+    )
+
+
+def migrate_2_to_3(migrator):
+    run_migrate(
+        migrator.add_column('exercise', 'local_path', CharField(default="")),
+        migrator.add_index('exercise', ('local_path',), False)
+    )
+    for course in Course.select(Course.id, Course.path):
+        course.update_local_paths()
+
+
+def migrate_3_to_4(migrator):
+    for table, column in [("exercise", "course_id"),
+                          ("exercise", "is_selected"),
+                          ("course", "is_selected")]:
+        sqlite.execute_sql("CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})"
+                           .format(table, column))
+
+
+def migrate_4_to_5(migrator):
+    run_migrate(
+        migrator.add_column('exercise', 'display_name', CharField(default=""))
+    )
+    for ex in Exercise.select(Exercise.id, Exercise.name):
+        Exercise.update(display_name=display_name(ex.name)).where(
+            Exercise.id == ex.id).execute()
+
+
+def migrate_5_to_6(migrator):
+    run_migrate(
+        migrator.add_column('exercise', 'checksum', CharField(default="")),
+        migrator.add_column('exercise', 'downloaded_checksum',
+                            CharField(default=""))
+    )
+
+migrations = [migrate_0_to_1, migrate_1_to_2, migrate_2_to_3, migrate_3_to_4,
+              migrate_4_to_5, migrate_5_to_6]
 
 def migrate():
     migrator = SqliteMigrator(sqlite)
     from_version = SchemaVersion.select().count()
     migrations_to_run = migrations[from_version:]
-    for index, migration in enumerate(migrations_to_run):
+    for index, migration in enumerate(migrations_to_run, from_version):
         print("Migrating database version {} to {} ..".format(index, index + 1),
               end="")
         with sqlite.transaction():
@@ -219,11 +681,10 @@ def init_db():
     Config.create_table(fail_silently=True)
     SchemaVersion.create_table(fail_silently=True)
 
-init_db()
-migrate()
 
 def reset_db():
     Course.drop_table()
     Exercise.drop_table()
     Config.drop_table()
+    row_cache.invalidate()
     init_db()
@@ -0,0 +1,369 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+from tmc.archive import _umask, member_mtime, member_path, staging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl that makes a copy-on-write clone of a file on Btrfs, XFS and friends.
+FICLONE = 0x40049409
+
+
+def default_directory():
+    """
+    The store goes to TMC_CACHEDIR if it's set and to tmc under the XDG
+    cache directory otherwise.
+    """
+    if "TMC_CACHEDIR" in os.environ:
+        return os.environ["TMC_CACHEDIR"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "tmc")
+
+
+class ExerciseStore(object):
+    """
+    A content addressed store of the exercise archives of one user, shared
+    by all of their course paths.
+
+    Archives are stored under the checksum the server gives the exercise
+    template. Each archive is also unpacked once into blobs named by the
+    SHA-256 of their contents, and a manifest maps the members of the
+    archive to those blobs. Checking out an exercise then only clones the
+    blobs into place instead of downloading and extracting the archive
+    again.
+
+    The archive itself is kept as well, which takes about as much disk
+    space again as its blobs. It's what blobs that went missing or were
+    changed through a hardlink are restored from without downloading the
+    exercise again, so max_size counts both.
+
+    The checked out files are reflinks where the file system supports them
+    and copies otherwise, so they can be edited like any other file. Only
+    large assets that are never edited, the ones ending in link_suffixes,
+    are hardlinked. A hardlinked blob can still be changed through one of
+    its links, so blobs that are linked anywhere are checked against their
+    digest before they are checked out again, and restored from the archive
+    when they don't match.
+
+    When the store grows past max_size bytes the least recently used
+    archives are removed along with the blobs no other archive uses. The
+    store is only a cache, so callers should treat an OSError from it as a
+    miss.
+    """
+
+    link_suffixes = (".jar",)
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        # What evict needs to know about the store, loaded on the first
+        # eviction and kept up to date by add.
+        self.lock = threading.Lock()
+        self.index = None
+        self.references = None
+        self.sizes = None
+        self.total = 0
+
+    @staticmethod
+    def valid_key(key):
+        """
+        Keys become file names, so only hex strings like the checksums the
+        server sends are accepted.
+        """
+        return isinstance(key, str) and bool(re.match(r"[0-9a-fA-F]+\Z",
+                                                      key))
+
+    def _archive_path(self, key):
+        if not self.valid_key(key):
+            raise ValueError("Invalid exercise store key: {0!r}".format(key))
+        return os.path.join(self.directory, "archives", key + ".zip")
+
+    def _manifest_path(self, key):
+        if not self.valid_key(key):
+            raise ValueError("Invalid exercise store key: {0!r}".format(key))
+        return os.path.join(self.directory, "archives", key + ".json")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def archive(self, key):
+        """
+        Returns the path of the stored archive for key and marks it as
+        recently used, or None if it isn't in the store.
+        """
+        path = self._archive_path(key)
+        try:
+            os.utime(self._manifest_path(key), None)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        with self.lock:
+            if self.index is not None and key in self.index:
+                self.index[key][0] = time.time()
+        return path
+
+    def add(self, key, filename):
+        """
+        Copies the archive filename into the store under key, unpacks its
+        blobs and returns the path of the stored archive.
+        """
+        path = self._archive_path(key)
+        os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix=".tmc-")
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, tmppath)
+            with zipfile.ZipFile(tmppath) as zipfp:
+                manifest = [self._add_member(zipfp, info)
+                            for info in zipfp.infolist()]
+            os.replace(tmppath, path)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+        self._write_manifest(key, manifest)
+        with self.lock:
+            if self.index is not None:
+                self._index_archive(key, manifest)
+        self.evict(keep=key)
+        return path
+
+    def _add_member(self, zipfp, info):
+        """
+        Stores the contents of a zip member as a blob and returns its
+        manifest entry: the name, the digest and the modification time.
+        """
+        mtime = member_mtime(info)
+        if info.filename.endswith("/"):
+            return [info.filename, None, mtime]
+        blobs = os.path.join(self.directory, "blobs")
+        os.makedirs(blobs, 0o700, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=blobs, prefix=".tmc-")
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as dst, zipfp.open(info) as src:
+                for block in iter(lambda: src.read(64 * 1024), b""):
+                    digest.update(block)
+                    dst.write(block)
+            blob = self._blob_path(digest.hexdigest())
+            if os.path.isfile(blob):
+                os.remove(tmppath)
+            else:
+                os.chmod(tmppath, 0o444)
+                os.utime(tmppath, (mtime, mtime))
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(tmppath, blob)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        return [info.filename, digest.hexdigest(), mtime]
+
+    def _write_manifest(self, key, manifest):
+        path = self._manifest_path(key)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix=".tmc-")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(manifest, fp)
+        os.replace(tmppath, path)
+
+    def _read_manifest(self, path):
+        try:
+            with open(path, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _verify(self, digest):
+        """
+        Is the blob for digest there and intact. Blobs that nothing links to
+        and that are still read-only can't have changed, so only the others
+        are hashed. A blob that doesn't match its digest is removed.
+        """
+        blob = self._blob_path(digest)
+        try:
+            stat = os.stat(blob)
+        except OSError:
+            return False
+        if stat.st_nlink == 1 and not stat.st_mode & 0o222:
+            return True
+        actual = hashlib.sha256()
+        with open(blob, "rb") as fp:
+            for block in iter(lambda: fp.read(64 * 1024), b""):
+                actual.update(block)
+        if actual.hexdigest() == digest:
+            return True
+        remove(blob)
+        return False
+
+    def _repair(self, key, manifest):
+        """
+        Unpacks the blobs of the archive stored under key again, which
+        brings back the ones that are missing. Returns False if the archive
+        is gone or no longer matches manifest.
+        """
+        try:
+            with zipfile.ZipFile(self._archive_path(key)) as zipfp:
+                unpacked = [self._add_member(zipfp, info)
+                            for info in zipfp.infolist()]
+        except (OSError, zipfile.BadZipFile):
+            return False
+        return unpacked == manifest
+
+    def checkout(self, key, outpath, root):
+        """
+        Checks out the archive stored under key into outpath, where root is
+        the directory of the exercise. Like archive.extract_all the exercise
+        is built in a staging directory and root only appears once it's
+        complete.
+
+        Blobs that are missing or damaged are restored from the stored
+        archive first. Returns False if the archive isn't in the store or
+        can't be restored from, and nothing was checked out.
+        """
+        manifest = self._read_manifest(self._manifest_path(key))
+        if manifest is None:
+            return False
+        # Every blob is verified, so that all the damaged ones are removed
+        # and get unpacked again by the repair.
+        if not all([digest is None or self._verify(digest)
+                    for _, digest, _ in manifest]):
+            if not self._repair(key, manifest):
+                return False
+        with staging(outpath, root) as tmpdir:
+            directories = []
+            for name, digest, mtime in manifest:
+                target = member_path(tmpdir, name)
+                if digest is None:
+                    os.makedirs(target, exist_ok=True)
+                    directories.append((target, mtime))
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                blob = self._blob_path(digest)
+                if not (name.endswith(self.link_suffixes)
+                        and link(blob, target)):
+                    clone(blob, target)
+            for target, mtime in sorted(directories, reverse=True):
+                os.utime(target, (mtime, mtime))
+        return True
+
+    def _load_index(self):
+        self.index = {}
+        self.references = {}
+        self.sizes = {}
+        self.total = 0
+        archives = os.path.join(self.directory, "archives")
+        for name in os.listdir(archives):
+            if name.endswith(".json"):
+                manifest = self._read_manifest(os.path.join(archives, name))
+                if manifest is not None:
+                    self._index_archive(name[:-len(".json")], manifest)
+
+    def _index_archive(self, key, manifest):
+        if key in self.index:
+            self._unindex_archive(key)
+        try:
+            used = os.stat(self._manifest_path(key)).st_mtime
+            size = os.path.getsize(self._archive_path(key))
+        except OSError:
+            used, size = 0, 0
+        digests = set(digest for _, digest, _ in manifest if digest)
+        self.index[key] = [used, size, digests]
+        self.total += size
+        for digest in digests:
+            if digest not in self.references:
+                self.references[digest] = 0
+                try:
+                    self.sizes[digest] = os.path.getsize(
+                        self._blob_path(digest))
+                except OSError:
+                    self.sizes[digest] = 0
+                self.total += self.sizes[digest]
+            self.references[digest] += 1
+
+    def _unindex_archive(self, key):
+        """
+        Forgets an archive and returns the blobs that nothing uses anymore.
+        """
+        _, size, digests = self.index.pop(key)
+        self.total -= size
+        unused = []
+        for digest in digests:
+            self.references[digest] -= 1
+            if not self.references[digest]:
+                del self.references[digest]
+                self.total -= self.sizes.pop(digest)
+                unused.append(digest)
+        return unused
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used archives and the blobs that only
+        they used until the store fits in max_size. The archive under keep
+        is never removed. The store is scanned on the first call only, after
+        that add keeps track of what it contains.
+        """
+        with self.lock:
+            if self.index is None:
+                self._load_index()
+            if self.total <= self.max_size:
+                return
+            entries = sorted((used, key) for key, (used, _, _)
+                             in self.index.items() if key != keep)
+            for _, key in entries:
+                if self.total <= self.max_size:
+                    break
+                remove(self._manifest_path(key))
+                remove(self._archive_path(key))
+                for digest in self._unindex_archive(key):
+                    remove(self._blob_path(digest))
+
+
+def link(blob, target):
+    """
+    Hardlinks blob to target, replacing whatever was there. Returns False if
+    the file system can't do it, for example when target is on another one.
+    """
+    tmppath = target + ".tmc-link"
+    try:
+        os.link(blob, tmppath)
+        os.replace(tmppath, target)
+    except (OSError, AttributeError):
+        remove(tmppath)
+        return False
+    return True
+
+
+def clone(blob, target):
+    """
+    Copies blob to target as a normal writable file with the same
+    modification time. The copy is a reflink sharing its blocks with blob
+    where the file system supports it.
+    """
+    with open(blob, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (AttributeError, OSError):
+            shutil.copyfileobj(src, dst, 64 * 1024)
+    os.chmod(target, 0o666 & ~_umask)
+    mtime = os.stat(blob).st_mtime
+    os.utime(target, (mtime, mtime))
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -3,6 +3,7 @@ Contains various test for nosetest.
 """
 
 import os
+import subprocess
 import sys
 from os import path
 
@@ -31,6 +32,184 @@ def test_version():
     assert "tmc.py version {}".format(version) in stdout
 
 
+def test_lazy_imports():
+    """
+    Starting up doesn't import the network, database, UI or test runner
+    modules
+    """
+    code = ("import sys, tmc.__main__; print(' '.join(m for m in "
+            "['requests', 'curses', 'tmc.ui.menu', 'tmc.exercise_tests', "
+            "'tmc.models', 'peewee'] if m in sys.modules))")
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.decode("utf-8").strip() == ""
+
+
+def test_lazy_config():
+    """
+    Starting up, or the background update check, doesn't read tmc.ini
+    """
+    code = ("import tmc.__main__, tmc.updates; from tmc import conf; "
+            "print(conf.loaded)")
+    out = subprocess.check_output([sys.executable, "-c", code])
+    assert out.decode("utf-8").strip() == "False"
+
+
+def test_submit_defaults():
+    """
+    Submitting without options uses the default timeout and job count
+    """
+    import tmc.files as files
+    import tmc.models as models
+    calls = []
+
+    class Selected(object):
+        @staticmethod
+        def get_selected():
+            return "selected"
+
+        @staticmethod
+        def byid(tid):
+            return tid
+
+    def submit_exercise(exercise, **kwargs):
+        calls.append((exercise, kwargs))
+
+    def submit_exercises(exercises, **kwargs):
+        calls.append((exercises, kwargs))
+
+    saved = (models.Course, models.Exercise, files.submit_exercise,
+             files.submit_exercises)
+    models.Course = models.Exercise = Selected
+    files.submit_exercise = submit_exercise
+    files.submit_exercises = submit_exercises
+    try:
+        _, _, ex = run_command("submit")
+        assert ex is None
+        _, _, ex = run_command(["submit", "-i", "1", "2"])
+        assert ex is None
+    finally:
+        (models.Course, models.Exercise, files.submit_exercise,
+         files.submit_exercises) = saved
+    defaults = {"pastebin": False, "request_review": False, "timeout": 300}
+    assert calls == [("selected", defaults),
+                     (["1", "2"], dict(defaults, jobs=4))]
+
+
+def test_async_api():
+    """
+    The asyncio client runs requests concurrently up to its limit
+    """
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from tmc.async_api import AsyncAPI
+    from tmc.backoff import CircuitBreaker
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(0.2)
+            body = b'{"courses": [{"id": 1}]}'
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class FakeAPI(object):
+        configured = True
+        params = {}
+        auth_header = {}
+        breaker = CircuitBreaker()
+
+        def _make_url(self, slug):
+            return "http://127.0.0.1:{0}/{1}".format(server.server_port, slug)
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        async_api = AsyncAPI(FakeAPI(), limit=4)
+        started = time.time()
+        results = async_api.run([async_api.get_courses() for _ in range(8)])
+        elapsed = time.time() - started
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert results == [[{"id": 1}]] * 8
+    assert 0.4 <= elapsed < 1.2
+
+
+def test_exercise_store():
+    """
+    Exercises are checked out of the store intact, edits to the checkout
+    don't reach the store and eviction keeps the newest archive
+    """
+    import shutil
+    import tempfile
+    import zipfile
+    from tmc.store import ExerciseStore
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        zippath = path.join(tmpdir, "exercise.zip")
+        with zipfile.ZipFile(zippath, "w") as zipfp:
+            zipfp.writestr("week1/Ex1/src/Main.java", "class Main {}")
+            zipfp.writestr("week1/Ex1/lib/junit.jar", "jar")
+            zipfp.writestr("week1/Ex1/nbproject/project.properties",
+                           "javac=1.6")
+
+        store = ExerciseStore(path.join(tmpdir, "store"))
+        assert not store.valid_key("../../etc/passwd")
+        assert store.archive("abc123") is None
+        assert store.add("abc123", zippath) == store.archive("abc123")
+        assert path.isfile(zippath)
+
+        course = path.join(tmpdir, "course")
+        root = path.join(course, "week1", "Ex1")
+        assert store.checkout("abc123", course, root)
+        for name in ("src/Main.java", "nbproject/project.properties"):
+            with open(path.join(root, name), "a") as fp:
+                fp.write("edited")
+        assert os.stat(path.join(root, "lib", "junit.jar")).st_nlink == 2
+
+        # Damage the linked jar through the checkout. The store repairs it
+        # from the stored archive.
+        os.chmod(path.join(root, "lib", "junit.jar"), 0o644)
+        with open(path.join(root, "lib", "junit.jar"), "w") as fp:
+            fp.write("broken")
+        other = path.join(tmpdir, "other")
+        other_root = path.join(other, "week1", "Ex1")
+        assert store.checkout("abc123", other, other_root)
+        with open(path.join(other_root, "lib", "junit.jar")) as fp:
+            assert fp.read() == "jar"
+        with open(path.join(other_root, "nbproject",
+                            "project.properties")) as fp:
+            assert fp.read() == "javac=1.6"
+
+        # Without the archive there's nothing to repair from.
+        os.chmod(path.join(other_root, "lib", "junit.jar"), 0o644)
+        with open(path.join(other_root, "lib", "junit.jar"), "w") as fp:
+            fp.write("broken")
+        os.remove(store.archive("abc123"))
+        third = path.join(tmpdir, "third")
+        assert not store.checkout("abc123", third,
+                                  path.join(third, "week1", "Ex1"))
+        assert not path.exists(path.join(third, "week1"))
+
+        store.add("abc123", zippath)
+        store.max_size = 0
+        store.add("def456", zippath)
+        assert store.archive("abc123") is None
+        assert store.archive("def456") is not None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 def test_reset():
     """
     Database resetting works
@@ -0,0 +1,108 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+
+class HTTPTracer(object):
+    """
+    Records every HTTP request the API makes into a JSONL file and keeps them
+    in memory to print a per endpoint summary at exit.
+
+    Each record has the method, URL, status, the number of the attempt, the
+    time until the response headers arrived ("wait"), the total time spent
+    in the request and the bytes sent and received.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = []
+        self.lock = threading.Lock()
+        self.fp = None
+
+    def record(self, method, url, started, resp=None, attempt=1, error=None,
+               received=None):
+        if received is None:
+            received = self._received_bytes(resp)
+        total = time.time() - started
+        entry = OrderedDict([
+            ("time", started),
+            ("method", method),
+            ("url", url),
+            ("endpoint", self.endpoint(url)),
+            ("attempt", attempt),
+            ("status", resp.status_code if resp is not None else None),
+            ("wait", resp.elapsed.total_seconds()
+             if resp is not None else None),
+            ("total", total),
+            ("sent", self._sent_bytes(resp)),
+            ("received", received),
+            ("error", repr(error) if error is not None else None)
+        ])
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.filename, "a")
+            self.fp.write(json.dumps(entry) + "\n")
+            self.fp.flush()
+            self.records.append(entry)
+
+    @staticmethod
+    def endpoint(url):
+        """
+        Collapses the IDs in the path of url so that requests to the same
+        kind of resource are summarized together.
+        """
+        path = urlsplit(url).path
+        return re.sub(r"/\d+", "/:id", path)
+
+    @staticmethod
+    def _sent_bytes(resp):
+        if resp is None or resp.request.body is None:
+            return 0
+        return len(resp.request.body)
+
+    @staticmethod
+    def _received_bytes(resp):
+        if resp is None:
+            return 0
+        # Don't consume streamed bodies, their length is in the headers.
+        if resp._content_consumed:
+            return len(resp.content)
+        length = resp.headers.get("Content-Length", "")
+        return int(length) if length.isdigit() else 0
+
+    def print_summary(self, file=None):
+        """
+        Prints the request count, median and 95th percentile latency and the
+        bytes transferred for each endpoint.
+        """
+        if self.fp is not None:
+            self.fp.close()
+        if not self.records:
+            return
+        endpoints = OrderedDict()
+        for entry in self.records:
+            endpoints.setdefault(entry["endpoint"], []).append(entry)
+
+        line = "{0:>5} │ {1:>8} │ {2:>8} │ {3:>10} │ {4}"
+        print(line.format("Count", "p50 (s)", "p95 (s)", "Bytes", "Endpoint"),
+              file=file)
+        for endpoint, entries in endpoints.items():
+            times = sorted(entry["total"] for entry in entries)
+            transferred = sum(entry["sent"] + entry["received"]
+                              for entry in entries)
+            print(line.format(len(entries),
+                              "{0:.3f}".format(percentile(times, 50)),
+                              "{0:.3f}".format(percentile(times, 95)),
+                              transferred, endpoint), file=file)
+        print("Trace written to {0}".format(self.filename), file=file)
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
@@ -1,6 +1,17 @@
-import curses
 import math
-from curses import panel
+import os
+
+try:
+    import curses
+    from curses import panel
+except ImportError:
+    if os.name == "nt":
+        print("You seem to be running Windows. Please install curses",
+              "from http://www.lfd.uci.edu/~gohlke/pythonlibs/#curses")
+    else:
+        print("You don't have curses installed, please install it with",
+              "your package manager.")
+    exit(-1)
 
 from tmc import conf
 
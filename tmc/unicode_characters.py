@@ -7,9 +7,13 @@ class UnicodePrint(object):
     Very lazy class to replace stdout. It will strip a few unicode symbols and
     replace them with ASCII equivalents if the user has opted out of unicode
     stuff.
+
+    Pass the configuration as conf to have the option read on the first
+    write instead of when stdout is replaced.
     """
-    def __init__(self, unicode=True):
+    def __init__(self, unicode=True, conf=None):
         self.use_unicode = unicode
+        self.conf = conf
         self.chars = {
             "✔": "Y",
             "✘": "N",
@@ -21,6 +25,9 @@ class UnicodePrint(object):
     def write(self, text):
         if len(text) == 0:
             return
+        if self.conf is not None:
+            self.use_unicode = self.conf.use_unicode_characters
+            self.conf = None
         if not self.use_unicode:
             text = self.pattern.sub(lambda x: self.chars[x.group()], text)
         sys.__stdout__.write(text)
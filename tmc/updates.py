@@ -0,0 +1,75 @@
+"""
+Checks PyPI for new versions of tmc.py without slowing down the commands.
+
+The check runs at most once a day in a detached process, which stores the
+newest version in the database. The next command then reads that value and
+tells the user about it.
+"""
+
+import json
+import os
+import sys
+import time
+from subprocess import Popen
+
+from tmc.models import Config
+from tmc.version import __version__
+
+PYPI_URL = "https://pypi.org/pypi/tmc/json"
+CHECK_INTERVAL = 24 * 60 * 60
+
+
+def parse_version(version):
+    parts = []
+    for part in version.split("."):
+        digits = "".join(c for c in part if c.isdigit())
+        parts.append(int(digits) if digits else 0)
+    return tuple(parts)
+
+
+def fetch_latest_version(timeout=5):
+    """
+    Asks PyPI for the newest version of tmc.py and stores the answer.
+    """
+    from urllib.request import urlopen
+
+    with urlopen(PYPI_URL, timeout=timeout) as resp:
+        latest = json.loads(resp.read().decode("utf-8"))["info"]["version"]
+    Config.set("latest_version", latest)
+    return latest
+
+
+def newer_version():
+    """
+    Returns the newest version found by the last check if it's newer than
+    the running one, otherwise None.
+    """
+    if not Config.has_name("latest_version"):
+        return None
+    latest = Config.get_value("latest_version")
+    if parse_version(latest) > parse_version(__version__):
+        return latest
+    return None
+
+
+def check_in_background():
+    """
+    Starts a detached check for a new version unless one was started during
+    the last day.
+    """
+    last_check = 0
+    if Config.has_name("last_update_check"):
+        last_check = float(Config.get_value("last_update_check"))
+    if time.time() - last_check < CHECK_INTERVAL:
+        return
+    Config.set("last_update_check", int(time.time()))
+    with open(os.devnull, "wb") as devnull:
+        Popen([sys.executable, "-m", "tmc.updates"], stdin=devnull,
+              stdout=devnull, stderr=devnull, start_new_session=True)
+
+
+if __name__ == "__main__":
+    try:
+        fetch_latest_version()
+    except (OSError, ValueError, KeyError):
+        pass